@@ -0,0 +1,568 @@
+from tornado import concurrent
+from tornado import gen
+from tornado import ioloop
+from tornado import web
+from tornado import websocket
+
+import argparse
+import configparser
+import base64
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import mido
+
+BENCH_VERSION = 1
+
+
+def load_bridge(path='obs-control.py'):
+    spec = importlib.util.spec_from_file_location('obs_control', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_bridge_settings(bridge, name=''):
+    config = configparser.ConfigParser()
+    config.read(bridge.CONFIG_FILE)
+    return bridge.load_settings(config, name)
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def pick(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 3)
+    return {
+        'count': len(samples),
+        'mean': round(sum(samples) / len(samples) * 1000, 3),
+        'p50': pick(0.50),
+        'p90': pick(0.90),
+        'p99': pick(0.99),
+        'max': round(samples[-1] * 1000, 3),
+    }
+
+
+class OBSEmulator(websocket.WebSocketHandler):
+    # Emulates obs-websocket 4.x: auth challenge, scenes, recording/streaming with configurable delays
+    def initialize(self, state):
+        self.state = state
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self):
+        self.set_nodelay(True)
+        self.state['connections'].append(self)
+
+    def on_close(self):
+        if self in self.state['connections']:
+            self.state['connections'].remove(self)
+
+    def reply(self, request, **data):
+        data['message-id'] = request.get('message-id', '')
+        data.setdefault('status', 'ok')
+        self.write_message(json.dumps(data))
+
+    def event(self, update_type, delay=0, **data):
+        data['update-type'] = update_type
+        frame = json.dumps(data)
+        if delay:
+            ioloop.IOLoop.current().call_later(delay, self.write_event, frame)
+        else:
+            self.write_event(frame)
+
+    def write_event(self, frame):
+        self.state['events_sent'].append(time.perf_counter())
+        if self.ws_connection:
+            self.write_message(frame)
+
+    def on_message(self, message):
+        received_at = time.perf_counter()
+        request = json.loads(message)
+        request_type = request['request-type']
+        self.state['requests'].append((received_at, request_type))
+        handler = getattr(self, 'request_' + request_type, None)
+        if handler is None:
+            self.reply(request, status='error', error='Unknown request {0}'.format(request_type))
+        else:
+            handler(request)
+
+    def request_GetAuthRequired(self, request):
+        if self.state['password']:
+            self.reply(request, authRequired=True, challenge=self.state['challenge'], salt=self.state['salt'])
+        else:
+            self.reply(request, authRequired=False)
+
+    def request_Authenticate(self, request):
+        secret = base64.b64encode(hashlib.sha256(
+            (self.state['password'] + self.state['salt']).encode('utf-8')).digest()).decode('utf-8')
+        expected = base64.b64encode(hashlib.sha256(
+            (secret + self.state['challenge']).encode('utf-8')).digest()).decode('utf-8')
+        if request.get('auth') == expected:
+            self.reply(request)
+        else:
+            self.reply(request, status='error', error='Authentication Failed.')
+
+    def request_GetSceneList(self, request):
+        self.reply(request, **{'current-scene': self.state['current_scene'],
+                               'scenes': [{'name': name, 'sources': []} for name in self.state['scenes']]})
+
+    def request_SetCurrentScene(self, request):
+        name = request['scene-name']
+        if name not in self.state['scenes']:
+            self.reply(request, status='error', error='requested scene does not exist')
+            return
+        self.state['current_scene'] = name
+        self.reply(request)
+        self.event('SwitchScenes', self.state['event_delay'], **{'scene-name': name, 'sources': []})
+
+    def request_GetStreamingStatus(self, request):
+        self.reply(request, streaming=self.state['streaming'], recording=self.state['recording'])
+
+    def request_GetTransitionList(self, request):
+        self.reply(request, **{'current-transition': 'Fade', 'transitions': [{'name': 'Cut'}, {'name': 'Fade'}]})
+
+    def request_GetCurrentTransition(self, request):
+        self.reply(request, name='Fade', duration=300)
+
+    def request_StartStopRecording(self, request):
+        self.toggle_output(request, 'recording', 'Recording')
+
+    def request_StartStopStreaming(self, request):
+        self.toggle_output(request, 'streaming', 'Stream')
+
+    def toggle_output(self, request, key, prefix):
+        self.reply(request)
+        delay = self.state['event_delay']
+        if self.state[key]:
+            self.event(prefix + 'Stopping', delay)
+            self.event(prefix + 'Stopped', delay * 2)
+        else:
+            self.event(prefix + 'Starting', delay)
+            self.event(prefix + 'Started', delay * 2)
+        self.state[key] = not self.state[key]
+
+
+def emulator_state(scenes, password, event_delay):
+    return {
+        'scenes': ['Scene {0}'.format(i) for i in range(scenes)],
+        'current_scene': 'Scene 0',
+        'password': password,
+        'challenge': base64.b64encode(os.urandom(16)).decode('utf-8'),
+        'salt': base64.b64encode(os.urandom(16)).decode('utf-8'),
+        'event_delay': event_delay,
+        'streaming': False,
+        'recording': False,
+        'connections': [],
+        'requests': [],
+        'events_sent': [],
+    }
+
+
+class VirtualRtMidiOut:
+    # Mimics rtmidi.MidiOut so the bridge uses its raw bytes output path
+    def __init__(self, port):
+        self.port = port
+
+    def send_message(self, message):
+        self.port.receive(tuple(message))
+
+
+class VirtualOutput:
+    def __init__(self):
+        self._rt = VirtualRtMidiOut(self)
+        self.messages = []
+        self.listeners = []
+
+    def receive(self, message):
+        sent_at = time.perf_counter()
+        self.messages.append((sent_at, message))
+        for listener in list(self.listeners):
+            listener(sent_at, message)
+
+    def send(self, message):
+        self.receive(tuple(message.bytes()))
+
+    def close(self):
+        pass
+
+
+class VirtualInput:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def press(self, message):
+        # Called from a feeder thread like rtmidi callback
+        self.callback(message)
+
+    def close(self):
+        pass
+
+
+def bench_classes(bridge):
+    class BenchMIDIControl(bridge.MIDIControl):
+        def open_ports(self):
+            self.in_port = VirtualInput(self.receive_message)
+            self.out_port = VirtualOutput()
+            self.raw_send = self.port_writer(self.out_port)
+
+    class BenchOBSControl(bridge.OBSControl):
+        midi_class = BenchMIDIControl
+
+        def __init__(self, *args, **kwargs):
+            self.scene_events = []
+            self.ready = concurrent.Future()
+            super().__init__(*args, **kwargs)
+
+        def on_switch_scenes(self, resp):
+            self.scene_events.append((time.perf_counter(), resp['scene-name']))
+            super().on_switch_scenes(resp)
+
+        @gen.coroutine
+        def init_state(self):
+            yield super().init_state()
+            if not self.ready.done():
+                self.ready.set_result(True)
+
+    return BenchOBSControl
+
+
+class ReplayWebSocket:
+    # Stands for OBSWebSocketClient, connection state and incoming frames are driven by Replay
+    writable = True
+    write_queue = ()
+
+    def __init__(self, obs, subprotocols=None):
+        self.obs = obs
+        self.subprotocols = subprotocols
+        self.selected_subprotocol = None
+        self.reconnects = 0
+        self.frames = []
+
+    def connect(self, url):
+        pass
+
+    def send(self, data):
+        self.frames.append(data)
+
+    def recovered(self):
+        return None
+
+
+def replay_classes(bridge):
+    class ReplayOBSControl(bench_classes(bridge)):
+        ws_class = ReplayWebSocket
+
+    return ReplayOBSControl
+
+
+def read_trace(path, session=-1):
+    # Trace is appended by every bridge run, each run starts with "trace start" frame
+    sessions = []
+    with open(path) as f:
+        for line in f:
+            timestamp, channel, payload = line.rstrip('\n').split(' ', 2)
+            if channel == 'trace':
+                sessions.append([])
+                continue
+            if channel in ('midi-in', 'midi-out'):
+                data = tuple(bytes.fromhex(payload))
+            elif channel in ('ws-in', 'ws-out') and not payload.startswith('{'):
+                data = bytes.fromhex(payload)
+            else:
+                data = payload
+            if not sessions:
+                sessions.append([])
+            sessions[-1].append((float(timestamp), channel, data))
+    return sessions[session]
+
+
+def compare_streams(recorded, replayed):
+    mismatch = None
+    for index, (expected, actual) in enumerate(zip(recorded, replayed)):
+        if expected != actual:
+            mismatch = index
+            break
+    else:
+        if len(recorded) != len(replayed):
+            mismatch = min(len(recorded), len(replayed))
+    result = {'recorded': len(recorded), 'replayed': len(replayed), 'matched': mismatch is None}
+    if mismatch is not None:
+        def show(stream):
+            if mismatch >= len(stream):
+                return None
+            data = stream[mismatch]
+            return data if isinstance(data, str) else bytes(data).hex()
+        result['first_mismatch'] = {'index': mismatch, 'recorded': show(recorded), 'replayed': show(replayed)}
+    return result
+
+
+class Replay:
+    # Feeds recorded MIDI input and OBS frames through the bridge and compares its output with the recording
+    def __init__(self, args):
+        self.args = args
+        self.bridge = load_bridge(args.bridge)
+        # Same config as recorded bridge, without its own capture
+        self.settings = load_bridge_settings(self.bridge, args.name)._replace(
+            mapping_file=args.mapping, capture_size=0, trace_file='')
+        self.frames = read_trace(args.replay, args.session)
+
+    @staticmethod
+    @gen.coroutine
+    def settle():
+        # Input processing and LED flush are scheduled callbacks, let them run before next frame
+        for _ in range(3):
+            yield gen.moment
+
+    @gen.coroutine
+    def run(self):
+        frames = self.frames
+        binary = any(isinstance(data, bytes) for _, channel, data in frames if channel == 'ws-in')
+        obs = replay_classes(self.bridge)(self.settings)
+        obs.ws.selected_subprotocol = 'obswebsocket.msgpack' if binary else None
+        yield self.settle()
+        input_channels = ('midi-in', 'ws-in', 'ws-state')
+        inputs = [frame for frame in frames if frame[1] in input_channels]
+        origin = frames[0][0] if frames else 0
+        started_at = time.perf_counter()
+        for index, (timestamp, channel, data) in enumerate(frames):
+            if channel not in input_channels:
+                continue
+            # Inputs of one recorded IOLoop iteration are fed without yielding between them
+            if self.args.speed > 0 and (index == 0 or frames[index - 1][1] not in input_channels):
+                delay = started_at + (timestamp - origin) / self.args.speed - time.perf_counter()
+                if delay > 0:
+                    yield gen.sleep(delay)
+            if channel == 'midi-in':
+                obs.midi.in_port.press(mido.Message.from_bytes(data))
+                # Port callback schedules input processing, handle press before the next recorded frame
+                obs.midi.process_input_queue()
+            elif channel == 'ws-in':
+                obs.process_response(data)
+            elif data == 'open':
+                obs.on_connect()
+            else:
+                obs.on_disconnect()
+            # Inputs recorded without output between them were handled in one IOLoop iteration
+            if index + 1 == len(frames) or frames[index + 1][1] not in input_channels:
+                yield self.settle()
+        elapsed = time.perf_counter() - started_at
+        midi_out = [data for _, channel, data in frames if channel == 'midi-out']
+        ws_out = [data for _, channel, data in frames if channel == 'ws-out']
+        return {
+            'bench_version': BENCH_VERSION,
+            'timestamp': time.time(),
+            'trace': self.args.replay,
+            'speed': self.args.speed,
+            'recorded_duration': round(frames[-1][0] - origin, 3) if frames else 0,
+            'elapsed': round(elapsed, 3),
+            'frames': len(inputs),
+            'frames_per_second': round(len(inputs) / elapsed, 1) if elapsed else None,
+            'midi_out': compare_streams(midi_out, [message for _, message in obs.midi.out_port.messages]),
+            'ws_out': compare_streams(ws_out, obs.ws.frames),
+        }
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.bridge = load_bridge(args.bridge)
+        self.settings = load_bridge_settings(self.bridge)._replace(
+            host='127.0.0.1', port=args.port, password=args.password or None, reset_controller=False,
+            init_sequence=False, protocol='4', request_timeout=args.request_timeout,
+            max_pending_requests=args.max_pending_requests, mapping_file=args.mapping, trace_file='',
+            # Latency stages are measured press -> request -> event -> LED, optimistic LED would come first
+            optimistic_leds=False)
+        self.state = emulator_state(args.scenes, args.password, args.event_delay / 1000.0)
+        self.obs = None
+
+    @gen.coroutine
+    def start(self):
+        app = web.Application([('/', OBSEmulator, {'state': self.state})])
+        self.server = app.listen(self.args.port, address='127.0.0.1')
+        obs_class = bench_classes(self.bridge)
+        self.obs = obs_class(self.settings)
+        yield gen.with_timeout(time.time() + 10, self.obs.ready)
+
+    def scene_pads(self):
+        pads = []
+        for scene in self.obs.midi.mapping.scenes:
+            if scene.scene_index < len(self.state['scenes']):
+                pads.append(scene)
+        return pads
+
+    @gen.coroutine
+    def press_and_wait(self, scene):
+        loop = ioloop.IOLoop.current()
+        done = concurrent.Future()
+        name = self.state['scenes'][scene.scene_index]
+
+        def on_led(sent_at, message):
+            if message == scene.active and not done.done():
+                loop.add_callback(done.set_result, sent_at)
+        out_port = self.obs.midi.out_port
+        out_port.listeners.append(on_led)
+        requests = len(self.state['requests'])
+        events = len(self.obs.scene_events)
+        pressed_at = time.perf_counter()
+        feeder = threading.Thread(target=self.obs.midi.in_port.press,
+                                  args=(mido.Message.from_bytes(scene.trigger),))
+        feeder.start()
+        try:
+            led_at = yield gen.with_timeout(time.time() + 5, done)
+        finally:
+            out_port.listeners.remove(on_led)
+            feeder.join()
+        request_at = next(t for t, r in self.state['requests'][requests:] if r == 'SetCurrentScene')
+        event_at = next(t for t, n in self.obs.scene_events[events:] if n == name)
+        return pressed_at, request_at, event_at, led_at
+
+    @gen.coroutine
+    def measure_latency(self):
+        pads = self.scene_pads()
+        samples = {'press_to_request': [], 'request_to_event': [], 'event_to_led': [], 'press_to_led': []}
+        for i in range(self.args.presses):
+            scene = pads[(i + 1) % len(pads)]
+            if self.state['current_scene'] == self.state['scenes'][scene.scene_index]:
+                scene = pads[(i + 2) % len(pads)]
+            pressed_at, request_at, event_at, led_at = yield self.press_and_wait(scene)
+            samples['press_to_request'].append(request_at - pressed_at)
+            samples['request_to_event'].append(event_at - request_at)
+            samples['event_to_led'].append(led_at - event_at)
+            samples['press_to_led'].append(led_at - pressed_at)
+        return {name: percentiles(values) for name, values in samples.items()}
+
+    @gen.coroutine
+    def measure_rate(self, rate):
+        pads = self.scene_pads()
+        count = max(1, int(rate * self.args.rate_duration))
+        press = self.obs.midi.in_port.press
+        messages = [mido.Message.from_bytes(pads[i % len(pads)].trigger) for i in range(count)]
+
+        def feed():
+            start = time.perf_counter()
+            for i, message in enumerate(messages):
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                press(message)
+        requests = len(self.state['requests'])
+        collapsed = getattr(self.obs, 'requests_collapsed', 0)
+
+        def handled_presses():
+            # Press is handled when its scene switch reached OBS or was superseded by a newer one while waiting
+            switches = sum(1 for _, method in self.state['requests'][requests:] if method == 'SetCurrentScene')
+            return switches + getattr(self.obs, 'requests_collapsed', 0) - collapsed
+        started_at = time.perf_counter()
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        deadline = started_at + self.args.rate_duration + self.args.rate_slack
+        while time.perf_counter() < deadline:
+            yield gen.sleep(0.01)
+            if not feeder.is_alive() and handled_presses() >= count:
+                break
+        feeder.join()
+        handled = handled_presses()
+        elapsed = time.perf_counter() - started_at
+        # Let pending responses drain before next step
+        yield gen.sleep(self.args.event_delay / 1000.0 + 0.1)
+        return {
+            'rate': rate,
+            'presses': count,
+            'handled': handled,
+            'elapsed': round(elapsed, 3),
+            'sustained': handled >= count and elapsed <= self.args.rate_duration + self.args.rate_slack,
+        }
+
+    @gen.coroutine
+    def measure_throughput(self):
+        steps = []
+        rate = self.args.min_rate
+        while rate <= self.args.max_rate:
+            step = yield self.measure_rate(rate)
+            steps.append(step)
+            if not step['sustained']:
+                break
+            rate *= 2
+        sustained = [step['rate'] for step in steps if step['sustained']]
+        return {'max_sustained_rate': max(sustained) if sustained else 0, 'steps': steps}
+
+    @gen.coroutine
+    def run(self):
+        yield self.start()
+        latency = yield self.measure_latency()
+        throughput = yield self.measure_throughput()
+        midi = self.obs.midi
+        stages = {}
+        metrics = getattr(self.obs, 'metrics', None)
+        if metrics is not None:
+            for name, histogram in metrics.histograms.items():
+                if histogram.count:
+                    stages[name] = {
+                        'count': histogram.count,
+                        'mean': round(histogram.sum / histogram.count * 1000, 3),
+                    }
+        return {
+            'bench_version': BENCH_VERSION,
+            'timestamp': time.time(),
+            'config': {
+                'scenes': self.args.scenes,
+                'presses': self.args.presses,
+                'event_delay_ms': self.args.event_delay,
+                'max_pending_requests': self.args.max_pending_requests,
+            },
+            'latency_ms': latency,
+            'throughput': throughput,
+            'stages_ms': stages,
+            'midi': {
+                'sent': midi.sent_messages,
+                'suppressed': midi.suppressed_messages,
+                'input': midi.input_stats(),
+            },
+        }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='OBS-Websockets-MIDI bridge latency benchmark')
+    parser.add_argument('--bridge', default='obs-control.py', help='bridge module to benchmark')
+    parser.add_argument('--mapping', default='midi-mapping.json', help='MIDI mapping file')
+    parser.add_argument('--port', type=int, default=14444, help='port of emulated obs-websocket server')
+    parser.add_argument('--password', default='benchpass', help='emulated server password, empty to disable auth')
+    parser.add_argument('--scenes', type=int, default=8, help='count of scenes in emulated OBS')
+    parser.add_argument('--event-delay', type=float, default=0, help='delay of OBS events in ms')
+    parser.add_argument('--presses', type=int, default=200, help='count of presses for latency measurement')
+    parser.add_argument('--min-rate', type=int, default=50, help='initial input rate in presses per second')
+    parser.add_argument('--max-rate', type=int, default=6400, help='maximal input rate in presses per second')
+    parser.add_argument('--rate-duration', type=float, default=1, help='duration of every input rate step in s')
+    parser.add_argument('--rate-slack', type=float, default=0.5, help='allowed lag after rate step in s')
+    parser.add_argument('--request-timeout', type=int, default=10, help='bridge request timeout in s')
+    parser.add_argument('--max-pending-requests', type=int, default=8, help='bridge pipelining depth')
+    parser.add_argument('--output', help='write JSON results to file instead of stdout')
+    parser.add_argument('--replay', help='replay bridge trace file instead of benchmark')
+    parser.add_argument('--name', default='',
+                        help='bridge name of replayed trace if config has [Bridge:<name>] sections')
+    parser.add_argument('--session', type=int, default=-1, help='index of bridge run in trace file, last by default')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='replay speed relative to recording, 0 for maximal speed')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    runner = Replay(args) if args.replay else Bench(args)
+    result = ioloop.IOLoop.current().run_sync(runner.run, timeout=None if args.replay else 600)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.replay and not (result['midi_out']['matched'] and result['ws_out']['matched']):
+        sys.exit(1)
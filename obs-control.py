@@ -1,21 +1,46 @@
+import time
+# Measured by --profile-startup, module imports are the first stage
+STARTED_AT = time.perf_counter()
+
+from tornado import concurrent
 from tornado import gen
 from tornado import httpclient
 from tornado import ioloop
 from tornado import websocket
 
 import json
+import os
 import logging
+import logging.handlers
+import queue
+import signal
+import atexit
 import base64
+import bisect
 import hashlib
-import mido
+import importlib
+import itertools
+import random
+import threading
+import functools
+from collections import deque, namedtuple, OrderedDict
 from configparser import ConfigParser
-import mido.backends.rtmidi
 
-Config = ConfigParser()
-Config.read('obs-control.conf')
-HOST = Config.get('OBS_WebSockets', 'host', fallback='127.0.0.1')
-PORT = Config.get('OBS_WebSockets', 'port', fallback='4444')
-PASSWORD = Config.get('OBS_WebSockets', 'password', fallback=None)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def import_optional(name):
+    # Optional modules used only by some settings are imported when needed
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+CONFIG_FILE = 'obs-control.conf'
 
 ERROR = -1
 STARTING = 1
@@ -23,45 +48,376 @@ STARTED = 2
 STOPPING = 3
 STOPPED = 4
 
+# Shortest transition duration OBS accepts, ms
+MIN_TRANSITION_DURATION = 50
+
+# type -> status, data fields
+MIDI_MESSAGE_TYPES = {
+    'note_on': (0x90, 'note', 'velocity'),
+    'note_off': (0x80, 'note', 'velocity'),
+    'control_change': (0xB0, 'control', 'value'),
+}
+
+RECORDING_UPDATES = {
+    'RecordingStarting': STARTING,
+    'RecordingStarted': STARTED,
+    'RecordingStopping': STOPPING,
+    'RecordingStopped': STOPPED,
+}
+STREAMING_UPDATES = {
+    'StreamStarting': STARTING,
+    'StreamStarted': STARTED,
+    'StreamStopping': STOPPING,
+    'StreamStopped': STOPPED,
+}
+
+
+Settings = namedtuple('Settings', [
+    'name', 'log_level', 'debug', 'dump_websockets_proto', 'dump_midi_proto',
+    'host', 'port', 'password', 'protocol', 'msgpack', 'connect_timeout', 'request_timeout',
+    'max_pending_requests', 'offline_requests', 'offline_queue_size', 'reconnect_delay', 'reconnect_max_delay',
+    'control_rate', 'write_queue_size', 'request_backlog_size',
+    'midi_backend', 'input_port', 'output_port', 'mapping_file', 'reset_controller', 'init_sequence',
+    'input_queue_size', 'animation_tick', 'optimistic_leds', 'optimistic_timeout', 'mapping_reload',
+    'mapping_poll_interval', 'metrics_address', 'metrics_port', 'capture_size', 'trace_file',
+])
+
+
+def load_settings(config, bridge=''):
+    # Options of [Bridge:<name>] section override [OBS_Control], [OBS_WebSockets] and [MIDI_Settings] ones
+    section = 'Bridge:' + bridge
+
+    def option(get, default_section, name, fallback):
+        if bridge and config.has_option(section, name):
+            return get(section, name)
+        return get(default_section, name, fallback=fallback)
+    log_level = config.getint('OBS_Control', 'log_level', fallback=20)
+    return Settings(
+        name=bridge,
+        log_level=log_level,
+        debug=log_level <= logging.DEBUG,
+        dump_websockets_proto=option(config.getboolean, 'OBS_Control', 'dump_websockets_proto', False),
+        dump_midi_proto=option(config.getboolean, 'OBS_Control', 'dump_midi_proto', False),
+        host=option(config.get, 'OBS_WebSockets', 'host', '127.0.0.1'),
+        port=option(config.get, 'OBS_WebSockets', 'port', '4444'),
+        password=option(config.get, 'OBS_WebSockets', 'password', None),
+        protocol=option(config.get, 'OBS_WebSockets', 'protocol', '4'),
+        msgpack=option(config.getboolean, 'OBS_WebSockets', 'msgpack', True),
+        connect_timeout=option(config.getint, 'OBS_WebSockets', 'connect_timeout', 10),
+        request_timeout=option(config.getint, 'OBS_WebSockets', 'request_timeout', 10),
+        max_pending_requests=option(config.getint, 'OBS_WebSockets', 'max_pending_requests', 8),
+        offline_requests=option(config.get, 'OBS_WebSockets', 'offline_requests', 'drop'),
+        offline_queue_size=option(config.getint, 'OBS_WebSockets', 'offline_queue_size', 16),
+        reconnect_delay=option(config.getfloat, 'OBS_WebSockets', 'reconnect_delay', 0.5),
+        reconnect_max_delay=option(config.getfloat, 'OBS_WebSockets', 'reconnect_max_delay', 30),
+        control_rate=option(config.getfloat, 'OBS_WebSockets', 'control_rate', 20),
+        write_queue_size=option(config.getint, 'OBS_WebSockets', 'write_queue_size', 16),
+        request_backlog_size=option(config.getint, 'OBS_WebSockets', 'request_backlog_size', 64),
+        midi_backend=option(config.get, 'MIDI_Settings', 'midi_backend', 'mido.backends.rtmidi'),
+        input_port=option(config.get, 'MIDI_Settings', 'input_port', None),
+        output_port=option(config.get, 'MIDI_Settings', 'output_port', None),
+        mapping_file=option(config.get, 'MIDI_Settings', 'mapping_file', 'midi-mapping.json'),
+        reset_controller=option(config.getboolean, 'MIDI_Settings', 'reset_controller', False),
+        init_sequence=option(config.getboolean, 'MIDI_Settings', 'init_sequence', False),
+        input_queue_size=option(config.getint, 'MIDI_Settings', 'input_queue_size', 256),
+        animation_tick=option(config.getfloat, 'MIDI_Settings', 'animation_tick', 0.05),
+        optimistic_leds=option(config.getboolean, 'MIDI_Settings', 'optimistic_leds', False),
+        optimistic_timeout=option(config.getfloat, 'MIDI_Settings', 'optimistic_timeout', 2),
+        mapping_reload=option(config.getboolean, 'MIDI_Settings', 'mapping_reload', True),
+        mapping_poll_interval=option(config.getfloat, 'MIDI_Settings', 'mapping_poll_interval', 1),
+        metrics_address=config.get('OBS_Control', 'metrics_address', fallback='127.0.0.1'),
+        metrics_port=config.getint('OBS_Control', 'metrics_port', fallback=0),
+        capture_size=option(config.getint, 'OBS_Control', 'capture_size', 4096),
+        trace_file=option(config.get, 'OBS_Control', 'trace_file', ''),
+    )
+
+
+def load_bridges(config):
+    names = [section[len('Bridge:'):] for section in config.sections() if section.startswith('Bridge:')]
+    bridges = [load_settings(config, name) for name in names] or [load_settings(config)]
+    for field in ('input_port', 'output_port', 'trace_file'):
+        values = [getattr(settings, field) for settings in bridges if getattr(settings, field)]
+        if len(values) != len(set(values)):
+            raise ValueError('Bridges must not share {0}'.format(field))
+    return bridges
+
 
 def setup_logger(level):
-    logging.basicConfig(format='%(asctime)s [%(levelname)s] : %(message)s',
-                        filename='obs-control.log',
-                        level=level)
+    formatter = logging.Formatter('%(asctime)s [%(levelname)s] : %(message)s')
+    file_lh = logging.FileHandler('obs-control.log')
+    file_lh.setFormatter(formatter)
+    stdout_lh = logging.StreamHandler()
+    stdout_lh.setFormatter(formatter)
+    stdout_lh.addFilter(lambda record: record.name == 'obs-control' or record.name.split('.')[0] == 'tornado')
+    # File and terminal are written by listener thread, IOLoop thread only enqueues records
+    records = queue.Queue()
+    listener = logging.handlers.QueueListener(records, file_lh, stdout_lh, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(records))
     log = logging.getLogger('obs-control')
     log.setLevel(level)
-    stdout_lh = logging.StreamHandler()
-    stdout_lh.setLevel(level)
-    stdout_lh.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] : %(message)s'))
-    log.addHandler(stdout_lh)
     return log
 
-log = setup_logger(Config.getint('OBS_Control', 'log_level', fallback=20))
-mido.set_backend(Config.get('MIDI_Settings', 'midi_backend', fallback='mido.backends.rtmidi'))
+
+def json_encode(data):
+    if orjson:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data, separators=(',', ':'))
+
+
+def json_decode(data):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+log = logging.getLogger('obs-control')
+
+
+class BridgeLog(logging.LoggerAdapter):
+    # Prefixes messages with bridge name when several bridges share the process
+    def process(self, msg, kwargs):
+        if self.extra['bridge']:
+            msg = '[{0}] {1}'.format(self.extra['bridge'], msg)
+        return msg, kwargs
+
+
+class Histogram:
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, help_text):
+        self.help = help_text
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, bridge='', prefix='obs_control'):
+        self.prefix = prefix
+        self.label = 'bridge="{0}"'.format(bridge) if bridge else ''
+        # (kind, time) of action being processed now, 'press' for MIDI input or 'event' for OBS message
+        self.origin = None
+        self.collectors = OrderedDict()
+        self.histograms = OrderedDict()
+        for name, help_text in (
+                ('midi_dispatch_seconds', 'MIDI message receive to dispatch'),
+                ('request_queue_seconds', 'OBS request creation to websocket send'),
+                ('press_to_request_seconds', 'MIDI press receive to websocket send'),
+                ('ws_write_seconds', 'Websocket frame queued to written to socket'),
+                ('obs_response_seconds', 'Websocket send to OBS response'),
+                ('press_to_led_seconds', 'MIDI press receive to LED send'),
+                ('event_to_led_seconds', 'OBS message receive to LED send'),
+                ('press_to_confirm_seconds', 'MIDI press receive to OBS confirming predicted LED state')):
+            self.histograms[name] = Histogram(help_text)
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def collect(self, name, metric_type, help_text, getter):
+        self.collectors[name] = (metric_type, help_text, getter)
+
+
+class ProtocolCapture:
+    def __init__(self, size, midi=True, websockets=True, trace_file=None, name='', log=log):
+        self.name = name
+        self.log = log
+        # Recent frames as (time, channel, data), channel is one of midi-in, midi-out, ws-in, ws-out, ws-state
+        self.frames = deque(maxlen=max(size, 1))
+        self.midi = midi and size > 0
+        self.websockets = websockets and size > 0
+        self.trace = None
+        self.trace_writer = None
+        if trace_file:
+            # Trace records every frame of both protocols, appended to file from writer thread
+            self.midi = self.websockets = True
+            self.trace = queue.Queue()
+            self.trace_writer = threading.Thread(target=self.write_trace, args=(trace_file,), name='trace-writer',
+                                                 daemon=True)
+            self.trace_writer.start()
+            atexit.register(self.close_trace)
+            self.log.info('Tracing to {0}'.format(trace_file))
+            self.add('trace', 'start')
+
+    def add(self, channel, data):
+        frame = (time.time(), channel, data)
+        self.frames.append(frame)
+        if self.trace is not None:
+            self.trace.put(frame)
+
+    def write_trace(self, path):
+        with open(path, 'a') as f:
+            while True:
+                frame = self.trace.get()
+                if frame is None:
+                    break
+                f.write(self.format_frame(*frame))
+                if self.trace.empty():
+                    f.flush()
+
+    def close_trace(self):
+        if self.trace_writer is not None:
+            self.trace.put(None)
+            self.trace_writer.join()
+            self.trace_writer = None
+
+    def snapshot(self):
+        # MIDI input is captured from rtmidi thread, retry if it appended while copying
+        while True:
+            try:
+                return list(self.frames)
+            except RuntimeError:
+                pass
+
+    @staticmethod
+    def format_frame(timestamp, channel, data):
+        if isinstance(data, str):
+            payload = data.replace('\n', ' ')
+        else:
+            payload = bytes(data).hex()
+        return '{0:.6f} {1} {2}\n'.format(timestamp, channel, payload)
+
+    def flush(self, path=None):
+        frames = self.snapshot()
+        if path is None:
+            prefix = 'obs-control-capture-' + (self.name + '-' if self.name else '')
+            path = time.strftime(prefix + '%Y%m%d-%H%M%S.log')
+
+        def write():
+            with open(path, 'w') as f:
+                f.writelines(self.format_frame(*frame) for frame in frames)
+            self.log.info('Captured {0} frames written to {1}'.format(len(frames), path))
+        threading.Thread(target=write, name='capture-writer').start()
+        return path
+
+
+class StartupProfile:
+    # Stages from process start to first LED frame showing OBS state, each stage is recorded once
+    def __init__(self, started, marks=()):
+        self.started = started
+        self.marks = OrderedDict(marks)
+
+    def mark(self, stage, at=None):
+        self.marks.setdefault(stage, time.perf_counter() if at is None else at)
+
+    def report(self, log):
+        marks = sorted(self.marks.items(), key=lambda mark: mark[1])
+        log.info('Startup profile, {0:.1f}ms to first LED frame:'.format((marks[-1][1] - self.started) * 1000))
+        previous = self.started
+        for stage, at in marks:
+            log.info('  {0:<24}{1:9.1f}ms {2:+9.1f}ms'.format(
+                stage, (at - self.started) * 1000, (at - previous) * 1000))
+            previous = at
+
+
+def render_metrics(metrics_list):
+    # Every bridge has the same metrics, each family is rendered once with bridge label per sample
+    lines = []
+    first = metrics_list[0]
+    for name, (metric_type, help_text, _) in first.collectors.items():
+        full_name = '{0}_{1}'.format(first.prefix, name)
+        lines.append('# HELP {0} {1}'.format(full_name, help_text))
+        lines.append('# TYPE {0} {1}'.format(full_name, metric_type))
+        for metrics in metrics_list:
+            labels = '{{{0}}}'.format(metrics.label) if metrics.label else ''
+            lines.append('{0}{1} {2}'.format(full_name, labels, metrics.collectors[name][2]()))
+    for name, histogram in first.histograms.items():
+        full_name = '{0}_{1}'.format(first.prefix, name)
+        lines.append('# HELP {0} {1}'.format(full_name, histogram.help))
+        lines.append('# TYPE {0} histogram'.format(full_name))
+        for metrics in metrics_list:
+            histogram = metrics.histograms[name]
+            labels = '{{{0}}}'.format(metrics.label) if metrics.label else ''
+            bucket_labels = metrics.label + ',' if metrics.label else ''
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('{0}_bucket{{{1}le="{2}"}} {3}'.format(full_name, bucket_labels, bucket, cumulative))
+            lines.append('{0}_sum{1} {2}'.format(full_name, labels, histogram.sum))
+            lines.append('{0}_count{1} {2}'.format(full_name, labels, histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(bridges, address, port):
+    from tornado import web
+
+    class MetricsHandler(web.RequestHandler):
+        def get(self):
+            self.set_header('Content-Type', 'text/plain; version=0.0.4')
+            self.write(render_metrics([bridge.metrics for bridge in bridges]))
+
+    class CaptureHandler(web.RequestHandler):
+        def post(self):
+            for bridge in bridges:
+                self.write(bridge.capture.flush() + '\n')
+    web.Application([
+        ('/metrics', MetricsHandler),
+        ('/capture', CaptureHandler),
+    ]).listen(port, address=address)
+    log.info('Metrics available at http://{0}:{1}/metrics'.format(address, port))
+
+
+class MIDIMapTrigger:
+    def __init__(self, action, target, message):
+        self.action = action
+        self.target = target
+        self.message = message
+
+
+class MIDIMapAnimation:
+    # Frames of one LED, looped every interval or played once over transition duration (sweep)
+    def __init__(self, frames, interval, sweep):
+        self.frames = frames
+        self.interval = interval
+        self.sweep = sweep
+
+    def __eq__(self, other):
+        return isinstance(other, MIDIMapAnimation) and vars(self) == vars(other)
+
+
+class MIDIMappingError(Exception):
+    pass
 
 
 class MIDIMapping:
-    def __init__(self, filename):
+    def __init__(self, filename, log=log):
         self.filename = filename
+        self.log = log
         self.config = None
         self.reset_controller = []
         self.init_sequence = []
         self.stream_toggle = None
         self.record_toggle = None
         self.scenes = []
+        self.scenes_by_index = {}
         self.sources = []
+        self.controls = []
+        self.led_sysex = None
+        # Dispatch index: raw message bytes -> trigger, and (status, number) -> trigger
+        # for controls where only the controller/note number matters
+        self.triggers = {}
+        self.wildcard_triggers = {}
         self.load_file()
-        self.set_mapping()
+        try:
+            self.set_mapping()
+        except (KeyError, TypeError, ValueError) as e:
+            raise MIDIMappingError('MIDI mapping {0} is invalid: {1!r}'.format(self.filename, e))
 
     def load_file(self):
         try:
             with open(self.filename, 'r') as f:
                 self.config = json.load(f)
-                log.info('MIDI mapping {0} loaded'.format(self.filename))
-        except ValueError as e:
-            log.critical('MIDI mapping reading failed')
-            print(e)
-            exit(1)
+                self.log.info('MIDI mapping {0} loaded'.format(self.filename))
+        except (OSError, ValueError) as e:
+            raise MIDIMappingError('MIDI mapping {0} reading failed: {1}'.format(self.filename, e))
 
     def set_mapping(self):
         self.set_reset_sequence(self.config['reset'])
@@ -69,7 +425,9 @@ class MIDIMapping:
         self.set_record_toggle(self.config['record'])
         self.set_stream_toggle(self.config['stream'])
         self.set_scenes(self.config['scenes'])
-        self.set_sources(self.config['sources'])
+        self.set_sources(self.config.get('sources', []))
+        self.set_controls(self.config.get('controls', []))
+        self.set_led_sysex(self.config.get('led_sysex'))
 
     def set_reset_sequence(self, data):
         for msg in data:
@@ -90,18 +448,140 @@ class MIDIMapping:
                 self.pending = pending
                 self.trigger = trigger
         for scene in data:
+            if int(scene['index']) in self.scenes_by_index:
+                self.log.warning('Scene index {0} is mapped twice, ignoring'.format(scene['index']))
+                continue
             self.scenes.append(MIDIMapSceneState(
                 int(scene['index']),
                 self.midi_message(scene['missing']),
                 self.midi_message(scene['inactive']),
                 self.midi_message(scene['active']),
-                self.midi_message(scene['transition']),
-                self.midi_message(scene['pending']),
-                self.midi_message(scene['switch']))
+                self.midi_state(scene['transition']),
+                self.midi_state(scene['pending']),
+                self.bind_trigger(scene['switch'], 'scene', int(scene['index'])))
             )
+            self.scenes_by_index[self.scenes[-1].scene_index] = self.scenes[-1]
 
     def set_sources(self, data):
-        pass
+        class MIDIMapSourceState:
+            def __init__(self, action, source, scene_index, missing, inactive, active, trigger):
+                self.action = action
+                self.source = source
+                # None for items of current scene
+                self.scene_index = scene_index
+                self.missing = missing
+                self.inactive = inactive
+                self.active = active
+                self.trigger = trigger
+        for source in data:
+            if 'source' not in source:
+                self.log.warning('Source mapping without source name, ignoring')
+                continue
+            action = source.get('action', 'visibility')
+            if action not in ('visibility', 'mute'):
+                raise MIDIMappingError('Source action {0} is not supported'.format(action))
+            state = MIDIMapSourceState(
+                action,
+                source['source'],
+                int(source['scene_index']) if 'scene_index' in source else None,
+                self.midi_message(source['missing']),
+                self.midi_message(source['inactive']),
+                self.midi_message(source['active']),
+                None)
+            state.trigger = self.bind_trigger(source['switch'], 'source', state)
+            self.sources.append(state)
+
+    def set_controls(self, data):
+        class MIDIMapControlState:
+            def __init__(self, action, source, minimum, maximum, curve, feedback):
+                self.action = action
+                self.source = source
+                # Status and control number of fader, value is taken from received message
+                self.message = None
+                self.minimum = minimum
+                self.maximum = maximum
+                self.curve = curve
+                self.feedback = feedback
+
+            @property
+            def target(self):
+                return self.action, self.source
+
+            def value(self, message):
+                return self.minimum + (self.maximum - self.minimum) * (message[2] / 127) ** self.curve
+
+            def feedback_message(self, value):
+                position = (value - self.minimum) / (self.maximum - self.minimum)
+                position = min(max(position, 0), 1) ** (1 / self.curve)
+                return self.message + (int(round(position * 127)),)
+        # action -> default minimum, maximum and curve
+        actions = {
+            'volume': (0.0, 1.0, 3.0),
+            'transition_duration': (MIN_TRANSITION_DURATION, 5000, 1.0),
+        }
+        for control in data:
+            action = control['action']
+            if action not in actions:
+                raise MIDIMappingError('Control action {0} is not supported'.format(action))
+            if control['control']['type'] != 'control_change':
+                raise MIDIMappingError('Control {0} must be bound to control_change'.format(action))
+            if action == 'volume' and 'source' not in control:
+                self.log.warning('Volume control without source name, ignoring')
+                continue
+            minimum, maximum, curve = actions[action]
+            state = MIDIMapControlState(
+                action,
+                control.get('source'),
+                float(control.get('min', minimum)),
+                float(control.get('max', maximum)),
+                float(control.get('curve', curve)),
+                bool(control.get('feedback', True)))
+            if state.maximum == state.minimum or state.curve <= 0:
+                raise MIDIMappingError('Control {0} range or curve is invalid'.format(action))
+            state.message = self.bind_trigger(dict(control['control'], value='any'), 'control', state)[:2]
+            self.controls.append(state)
+
+    def set_led_sysex(self, data):
+        class MIDIMapLEDSysEx:
+            def __init__(self, header, entry, min_entries, max_entries):
+                self.header = header
+                self.entry = entry
+                self.min_entries = min_entries
+                self.max_entries = max_entries
+
+            def frames(self, messages):
+                for i in range(0, len(messages), self.max_entries):
+                    data = [0xF0]
+                    data.extend(self.header)
+                    for message in messages[i:i + self.max_entries]:
+                        data.extend(self.entry_bytes(message))
+                    data.append(0xF7)
+                    yield tuple(data)
+
+            def entry_bytes(self, message):
+                value = 0 if message[0] & 0xF0 == 0x80 else message[2]
+                fields = {'channel': message[0] & 0x0F, 'number': message[1], 'value': value}
+                return [fields[b] if isinstance(b, str) else b for b in self.entry]
+        if not data:
+            return
+        fields = ('channel', 'number', 'value')
+        for part in ('header', 'entry'):
+            for b in data[part]:
+                if isinstance(b, str) and part == 'entry':
+                    if b not in fields:
+                        raise MIDIMappingError('LED SysEx entry field {0} is unknown, use one of {1}'.format(
+                            b, ', '.join(fields)))
+                elif not isinstance(b, int) or isinstance(b, bool) or not 0 <= b <= 127:
+                    raise MIDIMappingError('LED SysEx {0} byte {1!r} is out of range 0-127'.format(part, b))
+        sysex = MIDIMapLEDSysEx(
+            data['header'],
+            data['entry'],
+            int(data.get('min_entries', 2)),
+            int(data.get('max_entries', 64))
+        )
+        if sysex.min_entries < 1 or sysex.max_entries < 1:
+            raise MIDIMappingError('LED SysEx min_entries and max_entries must be positive')
+        self.led_sysex = sysex
 
     def set_record_toggle(self, state):
         class MIDIMapRecordState:
@@ -113,8 +593,8 @@ class MIDIMapping:
         self.record_toggle = MIDIMapRecordState(
             self.midi_message(state['inactive']),
             self.midi_message(state['active']),
-            self.midi_message(state['pending']),
-            self.midi_message(state['toggle'])
+            self.midi_state(state['pending']),
+            self.bind_trigger(state['toggle'], 'record')
         )
 
     def set_stream_toggle(self, state):
@@ -127,327 +607,1885 @@ class MIDIMapping:
         self.stream_toggle = MIDIMapStreamState(
             self.midi_message(state['inactive']),
             self.midi_message(state['active']),
-            self.midi_message(state['pending']),
-            self.midi_message(state['toggle'])
+            self.midi_state(state['pending']),
+            self.bind_trigger(state['toggle'], 'stream')
         )
 
-    def get_scene_mapping_by_index(self, index):
-        for scene in self.scenes:
-            if scene.scene_index == index:
-                return scene
-        return False
-
-    def midi_message(self, data):
-        if data['type'] == 'note_on':
-            return self.note_on_message(data['channel'], data['note'], data['velocity'])
-        elif data['type'] == 'note_off':
-            return self.note_off_message(data['channel'], data['note'], data['velocity'])
-        elif data['type'] == 'control_change':
-            return self.control_change_message(data['channel'], data['control'], data['value'])
-        else:
-            log.error('MIDI message type {0} is not supported'.format(data['type']))
-            exit(4)
-
-    @staticmethod
-    def note_on_message(channel, note, velocity):
-        return mido.Message('note_on', channel=channel, note=note, velocity=velocity)
+    def bind_trigger(self, data, action, target=None):
+        value_field = 'value' if data['type'] == 'control_change' else 'velocity'
+        wildcard = data.get(value_field) == 'any'
+        if wildcard:
+            data = dict(data)
+            data[value_field] = 0
+        message = self.midi_message(data)
+        key = message
+        table = self.triggers
+        if wildcard:
+            key = key[:2]
+            table = self.wildcard_triggers
+        if key in table:
+            self.log.warning('MIDI trigger {0} is already bound to {1}, ignoring binding to {2}'.format(
+                ' '.join('{0:02X}'.format(b) for b in message), table[key].action, action))
+            return message
+        table[key] = MIDIMapTrigger(action, target, message)
+        return message
+
+    def changed_leds(self, old):
+        # Returns scene indexes which LEDs differ from old mapping, removed scenes, changed toggles
+        # and sources and controls which LEDs are no longer used
+        scenes = [index for index, scene in self.scenes_by_index.items()
+                  if index not in old.scenes_by_index or vars(old.scenes_by_index[index]) != vars(scene)]
+        removed = [scene for index, scene in old.scenes_by_index.items() if index not in self.scenes_by_index]
+        record = vars(old.record_toggle) != vars(self.record_toggle)
+        stream = vars(old.stream_toggle) != vars(self.stream_toggle)
+        source_leds = {source.missing[:2] for source in self.sources}
+        removed_sources = [source for source in old.sources if source.missing[:2] not in source_leds]
+        control_leds = {control.message for control in self.controls if control.feedback}
+        removed_controls = [control for control in old.controls
+                            if control.feedback and control.message not in control_leds]
+        return scenes, removed, record, stream, removed_sources, removed_controls
+
+    def get_trigger(self, message):
+        trigger = self.triggers.get(message)
+        if trigger is None and (message[0] & 0xF0 != 0x90 or message[2]):
+            # note_on with velocity 0 is key release, it doesn't match "any" velocity
+            trigger = self.wildcard_triggers.get(message[:2])
+        return trigger
 
-    @staticmethod
-    def note_off_message(channel, note, velocity):
-        return mido.Message('note_off', channel=channel, note=note, velocity=velocity)
+    def get_scene_mapping_by_index(self, index):
+        return self.scenes_by_index.get(index, False)
+
+    @property
+    def uses_transition_duration(self):
+        return (any(control.action == 'transition_duration' for control in self.controls) or
+                any(isinstance(scene.transition, MIDIMapAnimation) and scene.transition.sweep for scene in self.scenes))
+
+    def midi_state(self, data):
+        # LED state is a message or an animation of messages
+        if 'frames' not in data:
+            return self.midi_message(data)
+        frames = tuple(self.midi_message(frame) for frame in data['frames'])
+        if not frames:
+            raise MIDIMappingError('Animation has no frames')
+        interval = float(data.get('interval', 0.25))
+        if interval <= 0:
+            raise MIDIMappingError('Animation interval must be positive')
+        return MIDIMapAnimation(frames, interval, bool(data.get('sweep', False)))
 
     @staticmethod
-    def control_change_message(channel, control, value):
-        return mido.Message('control_change', channel=channel, control=control, value=value)
+    def midi_message(data):
+        # Messages are compiled to raw bytes tuples once and written to the port as is
+        if data['type'] not in MIDI_MESSAGE_TYPES:
+            raise MIDIMappingError('MIDI message type {0} is not supported'.format(data['type']))
+        status, number, value = MIDI_MESSAGE_TYPES[data['type']]
+        for field, limit in (('channel', 15), (number, 127), (value, 127)):
+            if not isinstance(data[field], int) or not 0 <= data[field] <= limit:
+                raise ValueError('{0} {1} is out of range 0..{2}'.format(field, data[field], limit))
+        return status | data['channel'], data[number], data[value]
+
+
+class MIDIAnimation:
+    def __init__(self, address, animation, ticks):
+        self.address = address
+        self.animation = animation
+        self.frames = animation.frames
+        # Ticks per frame
+        self.ticks = ticks
+        self.index = 0
+        self.due = None
+        self.slot = None
+        # Message sent after sweep is over
+        self.final = None
+
+
+class MIDIAnimator:
+    # Timer wheel: animations wait in slot of the tick of their next frame, single periodic callback
+    # visits one slot per tick, so tick cost depends on frames due, not on count of animated LEDs
+    SLOTS = 64
+
+    def __init__(self, tick, write):
+        self.tick = tick
+        self.write = write
+        self.slots = [{} for _ in range(self.SLOTS)]
+        self.animations = {}
+        self.ticks = 0
+        self.callback = ioloop.PeriodicCallback(self.advance, tick * 1000)
+
+    def start(self, address, animation, duration=None):
+        current = self.animations.get(address)
+        if current is not None and current.animation is animation:
+            # Repaint of the same state keeps animation phase
+            self.write(current.frames[current.index])
+            return
+        self.cancel(address)
+        if animation.sweep:
+            if duration is None:
+                duration = animation.interval * len(animation.frames)
+            ticks = duration / len(animation.frames) / self.tick
+        else:
+            ticks = animation.interval / self.tick
+        entry = MIDIAnimation(address, animation, max(1, int(round(ticks))))
+        self.animations[address] = entry
+        self.write(entry.frames[0])
+        self.schedule(entry)
+        if not self.callback.is_running():
+            self.callback.start()
+
+    def schedule(self, entry):
+        entry.due = self.ticks + entry.ticks
+        entry.slot = self.slots[entry.due % self.SLOTS]
+        entry.slot[entry.address] = entry
+
+    def cancel(self, address):
+        entry = self.animations.pop(address, None)
+        if entry is not None:
+            del entry.slot[address]
+
+    def settle(self, address, message):
+        # Running sweep ends with message instead of being interrupted by it
+        entry = self.animations.get(address)
+        if entry is None or not entry.animation.sweep:
+            return False
+        entry.final = message
+        return True
+
+    def clear(self):
+        for slot in self.slots:
+            slot.clear()
+        self.animations.clear()
+        self.callback.stop()
+
+    def advance(self):
+        self.ticks += 1
+        slot = self.slots[self.ticks % self.SLOTS]
+        for entry in [entry for entry in slot.values() if entry.due <= self.ticks]:
+            del slot[entry.address]
+            entry.index += 1
+            if entry.index == len(entry.frames):
+                if entry.animation.sweep:
+                    del self.animations[entry.address]
+                    if entry.final is not None:
+                        self.write(entry.final)
+                    continue
+                entry.index = 0
+            self.write(entry.frames[entry.index])
+            self.schedule(entry)
+        if not self.animations:
+            self.callback.stop()
 
 
 class MIDIControl:
-    def __init__(self):
+    def __init__(self, obs):
+        self.obs = obs
+        self.settings = obs.settings
+        self.log = obs.log
+        self.metrics = obs.metrics
+        self.capture = obs.capture
+        self.backend = None
+        self.closed = False
         self.in_port = None
         self.out_port = None
-        self.open_ports()
-        self.mapping = MIDIMapping(Config.get('MIDI_Settings', 'mapping_file', fallback='midi-mapping.json'))
-        self.scene_triggers = []
-        self.source_triggers = []
-        if Config.getboolean('MIDI_Settings', 'reset_controller', fallback=False):
+        self.raw_send = None
+        self.mapping_watcher = None
+        self.loop = ioloop.IOLoop.current()
+        # Shadow of the controller state: LED address -> last message sent to it
+        self.led_state = {}
+        # Messages collected during current IOLoop iteration: LED address -> message
+        self.out_buffer = OrderedDict()
+        self.flush_scheduled = False
+        self.flush_origin = None
+        self.animator = MIDIAnimator(self.settings.animation_tick, self.send_frame)
+        self.sent_messages = 0
+        self.suppressed_messages = 0
+        self.packed_messages = 0
+        # Handoff from rtmidi callback thread, continuous controllers are kept
+        # in input_controls and queued by (status, control) so only latest value is processed
+        self.input_lock = threading.Lock()
+        self.input_queue = deque()
+        self.input_controls = {}
+        self.input_scheduled = False
+        self.input_queue_size = self.settings.input_queue_size
+        self.received_messages = 0
+        self.dropped_messages = 0
+        self.coalesced_messages = 0
+        for name, metric_type, help_text, getter in (
+                ('midi_messages_received_total', 'counter', 'MIDI messages received', lambda: self.received_messages),
+                ('midi_messages_dropped_total', 'counter', 'MIDI messages dropped by full input queue',
+                 lambda: self.dropped_messages),
+                ('midi_messages_coalesced_total', 'counter', 'MIDI control changes coalesced in input queue',
+                 lambda: self.coalesced_messages),
+                ('midi_input_queue_depth', 'gauge', 'MIDI messages waiting for processing',
+                 lambda: len(self.input_queue)),
+                ('midi_messages_sent_total', 'counter', 'MIDI messages sent', lambda: self.sent_messages),
+                ('midi_messages_suppressed_total', 'counter', 'Redundant LED messages not sent',
+                 lambda: self.suppressed_messages),
+                ('midi_messages_packed_total', 'counter', 'LED messages packed into SysEx frames',
+                 lambda: self.packed_messages),
+                ('midi_animations_active', 'gauge', 'LEDs being animated', lambda: len(self.animator.animations))):
+            self.metrics.collect(name, metric_type, help_text, getter)
+        try:
+            self.mapping = MIDIMapping(self.settings.mapping_file, self.log)
+        except MIDIMappingError as e:
+            self.log.critical(str(e))
+            exit(1)
+        self.obs.profile_mark('mapping loaded')
+        # MIDI backend import and ports opening run in a thread while websocket handshake goes on,
+        # messages sent meanwhile wait in output buffer
+        self.loop.add_future(self.loop.run_in_executor(None, self.open_ports), self.on_ports_opened)
+        self.mapping_stat = self.stat_mapping()
+        self.mapping_reload_timeout = None
+        self.mapping_reloading = False
+        if self.settings.mapping_reload:
+            self.watch_mapping()
+        self.actions = {
+            'scene': self.trigger_scene,
+            'source': self.trigger_source,
+            'record': self.trigger_record,
+            'stream': self.trigger_stream,
+            'control': self.trigger_control,
+        }
+        if self.settings.reset_controller:
             self.send_reset_controller()
-        if Config.getboolean('MIDI_Settings', 'init_sequence', fallback=False):
+        if self.settings.init_sequence:
             self.send_init_sequence()
 
     def open_ports(self):
-        log.debug('Trying open MIDI ports')
+        self.log.debug('Trying open MIDI ports')
+        import mido
+        # Backend per bridge instead of mido.set_backend(), bridges may use different MIDI APIs
+        self.backend = mido.Backend(self.settings.midi_backend)
         try:
-            self.in_port = mido.open_input(Config.get('MIDI_Settings', 'input_port'), callback=self.receive_message)
+            self.in_port = self.backend.open_input(self.settings.input_port, callback=self.receive_message)
         except OSError:
-            log.critical('MIDI Input port opening failed')
-            print('MIDI INs:', mido.get_input_names())
+            self.log.critical('MIDI Input port opening failed')
+            print('MIDI INs:', self.backend.get_input_names())
             exit(2)
         try:
-            self.out_port = mido.open_output(Config.get('MIDI_Settings', 'output_port'))
+            self.out_port = self.backend.open_output(self.settings.output_port)
         except OSError:
-            log.critical('MIDI Output port opening failed')
-            print('MIDI OUTs: ', mido.get_output_names())
+            self.log.critical('MIDI Output port opening failed')
+            print('MIDI OUTs: ', self.backend.get_output_names())
             exit(3)
+        self.raw_send = self.port_writer(self.out_port)
+
+    def on_ports_opened(self, future):
+        # Port opening failure exits with its code here, on the IOLoop thread
+        future.result()
+        if self.closed:
+            self.close_ports()
+            return
+        self.obs.profile_mark('MIDI ports opened')
+        if self.out_buffer:
+            self.flush_messages()
+        if self.settings.reset_controller or self.settings.init_sequence:
+            self.obs.profile_mark('controller reset sent')
+
+    @staticmethod
+    def port_writer(port):
+        # rtmidi ports take raw bytes directly, other backends get mido messages
+        rt = getattr(port, '_rt', None)
+        if rt is not None and hasattr(rt, 'send_message'):
+            return rt.send_message
+        import mido
+        return lambda message: port.send(mido.Message.from_bytes(message))
+
+    def send_message(self, message, force=False):
+        # Forced messages are neither cached nor coalesced, they go out in order
+        address = None if force else self.led_address(message)
+        if address is not None and self.animator.animations:
+            # Static state stops animation of the same LED
+            self.animator.cancel(address)
+        self.buffer_message(message, address)
+
+    def send_frame(self, message):
+        self.buffer_message(message, self.led_address(message))
+
+    def send_state(self, state, duration=None):
+        if isinstance(state, MIDIMapAnimation):
+            self.animator.start(self.led_address(state.frames[0]), state, duration)
+        else:
+            self.send_message(state)
+
+    def settle_state(self, message):
+        if not self.animator.settle(self.led_address(message), message):
+            self.send_message(message)
 
-    def send_message(self, message):
+    def buffer_message(self, message, address):
+        if address is None:
+            address = object()
+        elif address in self.out_buffer:
+            del self.out_buffer[address]
+        self.out_buffer[address] = message
+        if self.flush_origin is None:
+            self.flush_origin = self.metrics.origin
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.add_callback(self.flush_messages)
+
+    def flush_messages(self):
+        self.flush_scheduled = False
+        if self.raw_send is None:
+            # Ports are not opened yet
+            return
+        buffer, self.out_buffer = self.out_buffer, OrderedDict()
+        origin, self.flush_origin = self.flush_origin, None
+        frame = []
+        sent = 0
+        for address, message in buffer.items():
+            if isinstance(address, tuple):
+                last = self.led_state.get(address)
+                if last is not None and last == message:
+                    self.suppressed_messages += 1
+                    continue
+                frame.append((address, message))
+            else:
+                self.send_led_frame(frame)
+                sent += len(frame)
+                frame = []
+                self.write_message(message)
+        self.send_led_frame(frame)
+        sent += len(frame)
+        if origin is not None and sent:
+            self.metrics.observe(origin[0] + '_to_led_seconds', time.perf_counter() - origin[1])
+        if self.obs.profile is not None and sent:
+            self.obs.profile_led_frame()
+        if self.settings.debug:
+            self.log.debug('MIDI output flushed')
+
+    def send_led_frame(self, frame):
+        # frame is list of (address, message), state cache is updated only after messages are written
+        messages = [message for _, message in frame]
+        sysex = self.mapping.led_sysex
+        if sysex and len(messages) >= sysex.min_entries:
+            for message in sysex.frames(messages):
+                self.write_message(message)
+            self.packed_messages += len(messages)
+        else:
+            for message in messages:
+                self.write_message(message)
+        self.led_state.update(frame)
+
+    def write_message(self, message):
         # TODO: Catch exceptions
-        self.out_port.send(message)
-        log.debug('Sent MIDI message: {0}'.format(message))
-        if Config.getboolean('OBS_Control', 'dump_midi_proto', fallback=False):
-            print(message)
+        self.raw_send(message)
+        self.sent_messages += 1
+        if self.capture.midi:
+            self.capture.add('midi-out', message)
+
+    @staticmethod
+    def led_address(message):
+        # note_on and note_off of the same note address the same LED
+        status = message[0] & 0xF0
+        if status == 0x90 or status == 0x80:
+            return 0x90 | (message[0] & 0x0F), message[1]
+        elif status == 0xB0:
+            return message[0], message[1]
+        return None
+
+    def invalidate_led_state(self):
+        self.log.debug('Invalidating controller state cache')
+        self.led_state.clear()
 
     def receive_message(self, message):
-        log.debug('Received MIDI Message')
-        if Config.getboolean('OBS_Control', 'dump_midi_proto', fallback=False):
-            print(message)
-        ioloop.IOLoop().instance().spawn_callback(self.process_message, message)
+        # Runs on rtmidi callback thread
+        if self.settings.debug:
+            self.log.debug('Received MIDI Message')
+        message = tuple(message.bytes())
+        if self.capture.midi:
+            self.capture.add('midi-in', message)
+        # Only CCs bound to continuous controls are coalesced, other triggers fire on every message
+        mapping = self.mapping
+        continuous = (message[0] & 0xF0 == 0xB0 and message not in mapping.triggers and
+                      getattr(mapping.wildcard_triggers.get(message[:2]), 'action', None) == 'control')
+        with self.input_lock:
+            self.received_messages += 1
+            control = None
+            if continuous:
+                control = message[:2]
+                if control in self.input_controls:
+                    self.input_controls[control] = message
+                    self.coalesced_messages += 1
+                    return
+            if len(self.input_queue) >= self.input_queue_size:
+                self.dropped_messages += 1
+                return
+            if control is not None:
+                self.input_controls[control] = message
+            self.input_queue.append((control, message, time.perf_counter()))
+            if self.input_scheduled:
+                return
+            self.input_scheduled = True
+        self.loop.add_callback(self.process_input_queue)
+
+    def process_input_queue(self):
+        with self.input_lock:
+            queue, self.input_queue = self.input_queue, deque()
+            controls, self.input_controls = self.input_controls, {}
+            self.input_scheduled = False
+        try:
+            for control, message, received_at in queue:
+                if control is not None:
+                    message = controls[control]
+                self.metrics.observe('midi_dispatch_seconds', time.perf_counter() - received_at)
+                self.metrics.origin = ('press', received_at)
+                try:
+                    self.process_message(message)
+                except Exception:
+                    self.log.exception('Failed to process MIDI message {0}'.format(
+                        ' '.join('{0:02X}'.format(b) for b in message)))
+        finally:
+            self.metrics.origin = None
+
+    def input_stats(self):
+        with self.input_lock:
+            return {
+                'depth': len(self.input_queue),
+                'received': self.received_messages,
+                'dropped': self.dropped_messages,
+                'coalesced': self.coalesced_messages,
+            }
 
     def process_message(self, message):
-        scene_trigger = self.check_scene_triggers(message)
-        if scene_trigger:
-            self.send_scene_transition_state(scene_trigger.scene_index)
-            OBS.set_current_scene_by_index(scene_trigger.scene_index)
-        source_trigger = self.check_source_triggers(message)
-        if source_trigger:
-            pass  # OBS.Control.do_something_with_source
-        if self.mapping.record_toggle.trigger == message:
-            OBS.record_toggle()
-        if self.mapping.stream_toggle.trigger == message:
-            OBS.stream_toggle()
-
-    def check_scene_triggers(self, message):
-        for scene in self.mapping.scenes:
-            if scene.trigger == message:
-                return scene
-        return False
-
-    def check_source_triggers(self, message):
-        return False
+        trigger = self.mapping.get_trigger(message)
+        if trigger:
+            self.actions[trigger.action](trigger.target, message)
+
+    def trigger_scene(self, scene_index, message):
+        if not self.obs.optimistic:
+            self.send_scene_transition_state(scene_index)
+        self.obs.set_current_scene_by_index(scene_index)
+
+    def trigger_source(self, source, message):
+        self.obs.source_toggle(source)
+
+    def trigger_control(self, control, message):
+        # Fader already shows received value, feedback of the same value is suppressed by LED state cache
+        self.led_state[self.led_address(message)] = message
+        self.obs.set_control(control, control.value(message))
+
+    def trigger_record(self, target, message):
+        self.obs.record_toggle()
+
+    def trigger_stream(self, target, message):
+        self.obs.stream_toggle()
 
     def send_reset_controller(self):
-        log.info('Sending reset controller sequence')
+        self.log.info('Sending reset controller sequence')
+        self.animator.clear()
+        self.out_buffer.clear()
+        self.invalidate_led_state()
         for message in self.mapping.reset_controller:
-            self.send_message(message)
+            self.send_message(message, force=True)
 
     def send_init_sequence(self):
-        log.info('Sending initial sequence')
+        self.log.info('Sending initial sequence')
         for message in self.mapping.init_sequence:
-            self.send_message(message)
+            self.send_message(message, force=True)
 
     def send_record_state(self):
-        if OBS.recording_state == STARTING:
-            self.send_message(self.mapping.record_toggle.pending)
-        elif OBS.recording_state == STARTED:
+        state = self.obs.displayed_state('record', self.obs.recording_state)
+        if state == STARTING:
+            self.send_state(self.mapping.record_toggle.pending)
+        elif state == STARTED:
             self.send_message(self.mapping.record_toggle.active)
-        elif OBS.recording_state == STOPPING:
-            self.send_message(self.mapping.record_toggle.pending)
-        elif OBS.recording_state == STOPPED:
+        elif state == STOPPING:
+            self.send_state(self.mapping.record_toggle.pending)
+        elif state == STOPPED:
             self.send_message(self.mapping.record_toggle.inactive)
         else:
-            log.error('WRONG RECORDING STATE')
+            self.log.error('WRONG RECORDING STATE')
 
     def send_stream_state(self):
-        if OBS.streaming_state == STARTING:
-            self.send_message(self.mapping.stream_toggle.pending)
-        elif OBS.streaming_state == STARTED:
+        state = self.obs.displayed_state('stream', self.obs.streaming_state)
+        if state == STARTING:
+            self.send_state(self.mapping.stream_toggle.pending)
+        elif state == STARTED:
             self.send_message(self.mapping.stream_toggle.active)
-        elif OBS.streaming_state == STOPPING:
-            self.send_message(self.mapping.stream_toggle.pending)
-        elif OBS.streaming_state == STOPPED:
+        elif state == STOPPING:
+            self.send_state(self.mapping.stream_toggle.pending)
+        elif state == STOPPED:
             self.send_message(self.mapping.stream_toggle.inactive)
         else:
-            log.error('WRONG STREAMING STATE')
+            self.log.error('WRONG STREAMING STATE')
 
-    def send_scenes_state(self):
-        current_scene_index = OBS.get_current_scene_index()
-        for scene in self.mapping.scenes:
+    def send_scenes_state(self, indexes=None):
+        if indexes is None:
+            scenes = self.mapping.scenes
+        else:
+            scenes = [self.mapping.scenes_by_index[i] for i in indexes if i in self.mapping.scenes_by_index]
+        current_scene_index = self.obs.displayed_state('scene', self.obs.scenes.current_index)
+        for scene in scenes:
             if scene.scene_index == current_scene_index:
-                self.send_message(scene.active)
-            elif scene.scene_index <= (len(OBS.scenes) - 1):
+                self.settle_state(scene.active)
+            elif scene.scene_index < len(self.obs.scenes):
                 self.send_message(scene.inactive)
-            elif scene.scene_index > (len(OBS.scenes) - 1):
+            else:
                 self.send_message(scene.missing)
 
     def send_scene_pending_state(self, index):
-        for scene in self.mapping.scenes:
-            if scene.scene_index == index:
-                self.send_message(scene.pending)
+        scene = self.mapping.get_scene_mapping_by_index(index)
+        if scene:
+            self.send_state(scene.pending)
 
     def send_scene_transition_state(self, index):
-        for scene in self.mapping.scenes:
-            if scene.scene_index == index:
-                self.send_message(scene.transition)
+        scene = self.mapping.get_scene_mapping_by_index(index)
+        if scene:
+            self.send_state(scene.transition, self.obs.transition_duration())
+
+    def send_sources_state(self, sources=None):
+        for source in self.mapping.sources if sources is None else sources:
+            state = self.obs.source_state(source)
+            if state is None:
+                self.send_message(source.missing)
+            elif state:
+                self.send_message(source.active)
+            else:
+                self.send_message(source.inactive)
 
-    def send_source_state(self, state):
-        pass
+    def send_controls_state(self, controls=None):
+        for control in self.mapping.controls if controls is None else controls:
+            if not control.feedback or self.obs.control_busy(control):
+                continue
+            value = self.obs.control_state(control)
+            if value is not None:
+                self.send_message(control.feedback_message(value))
 
     def send_obs_state(self):
         self.send_record_state()
         self.send_scenes_state()
+        self.send_sources_state()
+        self.send_controls_state()
         self.send_stream_state()
 
+    def stat_mapping(self):
+        try:
+            stat = os.stat(self.settings.mapping_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def watch_mapping(self):
+        # Editors often replace file by rename, so directory is watched for events with mapping file name
+        inotify_simple = import_optional('inotify_simple')
+        if inotify_simple:
+            directory, name = os.path.split(os.path.abspath(self.settings.mapping_file))
+            inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+
+            def on_events(fd, events):
+                if any(event.name == name for event in inotify.read(timeout=0)):
+                    self.schedule_mapping_reload()
+            self.loop.add_handler(inotify.fileno(), on_events, ioloop.IOLoop.READ)
+            self.mapping_watcher = inotify
+        else:
+            def poll():
+                stat = self.stat_mapping()
+                if stat is not None and stat != self.mapping_stat:
+                    self.mapping_stat = stat
+                    self.schedule_mapping_reload()
+            self.mapping_watcher = ioloop.PeriodicCallback(poll, self.settings.mapping_poll_interval * 1000)
+            self.mapping_watcher.start()
+
+    def unwatch_mapping(self):
+        if self.mapping_watcher is None:
+            return
+        if isinstance(self.mapping_watcher, ioloop.PeriodicCallback):
+            self.mapping_watcher.stop()
+        else:
+            self.loop.remove_handler(self.mapping_watcher.fileno())
+            self.mapping_watcher.close()
+        self.mapping_watcher = None
+
+    def schedule_mapping_reload(self):
+        # Single save may produce several events, reload once they settle
+        if self.mapping_reload_timeout is not None:
+            self.loop.remove_timeout(self.mapping_reload_timeout)
+        self.mapping_reload_timeout = self.loop.call_later(0.1, self.reload_mapping)
+
+    @gen.coroutine
+    def reload_mapping(self):
+        self.mapping_reload_timeout = None
+        if self.mapping_reloading:
+            self.schedule_mapping_reload()
+            return
+        self.mapping_reloading = True
+        try:
+            # Parsing and compiling runs on executor thread, IOLoop keeps handling MIDI and OBS
+            mapping = yield self.loop.run_in_executor(None, MIDIMapping, self.settings.mapping_file, self.log)
+        except MIDIMappingError as e:
+            self.log.error('{0}, keeping previous mapping'.format(e))
+            return
+        finally:
+            self.mapping_reloading = False
+        old, self.mapping = self.mapping, mapping
+        scenes, removed, record, stream, removed_sources, removed_controls = mapping.changed_leds(old)
+        self.log.info('MIDI mapping reloaded, {0} scene LEDs changed, {1} removed'.format(len(scenes), len(removed)))
+        for scene in removed:
+            self.send_message(scene.missing)
+        for source in removed_sources:
+            self.send_message(source.missing)
+        for control in removed_controls:
+            self.send_message(control.message + (0,))
+        if scenes:
+            self.send_scenes_state(scenes)
+        if record:
+            self.send_record_state()
+        if stream:
+            self.send_stream_state()
+        self.send_sources_state()
+        self.send_controls_state()
+        self.obs.protocol.update_subscriptions()
+        self.obs.prefetch_sources()
+
     def close_ports(self):
+        self.closed = True
+        self.unwatch_mapping()
+        self.animator.clear()
         if self.in_port:
             self.in_port.close()
         if self.out_port:
+            if self.out_buffer:
+                self.flush_messages()
             self.out_port.close()
-        log.debug('MIDI ports closed')
+        self.log.debug('MIDI ports closed')
+        self.log.info('MIDI messages sent: {0}, suppressed: {1}, packed into SysEx: {2}'.format(
+            self.sent_messages, self.suppressed_messages, self.packed_messages))
+        self.log.info('MIDI messages received: {received}, dropped: {dropped}, coalesced: {coalesced}'.format(
+            **self.input_stats()))
 
     def __del__(self):
         self.close_ports()
 
 
+class OBSRequestError(Exception):
+    def __init__(self, message, resp=None):
+        super().__init__(message)
+        self.resp = resp
+
+
+class OBSRequestTimeout(OBSRequestError):
+    pass
+
+
+class OBSRequest:
+    def __init__(self, msg_id, method, data, callback, errback, origin=None):
+        self.msg_id = msg_id
+        self.method = method
+        self.data = data
+        self.callback = callback
+        self.errback = errback
+        self.future = concurrent.Future()
+        self.timeout = None
+        self.origin = origin
+        self.created_at = time.perf_counter()
+        self.sent_at = None
+
+
+class OBSPrediction:
+    def __init__(self, value, pressed_at, accepts):
+        self.value = value
+        self.pressed_at = pressed_at
+        # OBS states on the way to predicted one, they keep prediction pending
+        self.accepts = accepts
+        self.timeout = None
+
+
+class OBSThrottle:
+    # Sends latest value at most once per interval with single request in flight,
+    # value set while waiting replaces previous one, so resting value is always sent last
+    def __init__(self, interval, send, idle=None):
+        self.interval = interval
+        self.send = send
+        self.idle = idle
+        self.loop = ioloop.IOLoop.current()
+        self.value = None
+        self.pending = False
+        self.in_flight = False
+        self.sent_at = None
+        self.timeout = None
+        self.sent = 0
+        self.skipped = 0
+
+    @property
+    def busy(self):
+        return self.pending or self.in_flight
+
+    def set(self, value):
+        if self.pending:
+            self.skipped += 1
+        self.value = value
+        self.pending = True
+        self.schedule()
+
+    def schedule(self):
+        if not self.pending or self.in_flight or self.timeout is not None:
+            return
+        delay = 0 if self.sent_at is None else self.sent_at + self.interval - self.loop.time()
+        if delay > 0:
+            self.timeout = self.loop.call_later(delay, self.fire)
+        else:
+            self.fire()
+
+    def fire(self):
+        self.timeout = None
+        self.pending = False
+        self.in_flight = True
+        self.sent_at = self.loop.time()
+        self.sent += 1
+        self.loop.add_future(self.send(self.value), self.on_done)
+
+    def on_done(self, future):
+        self.in_flight = False
+        self.schedule()
+        if not self.busy and self.idle is not None:
+            self.idle()
+
+    def cancel(self):
+        if self.timeout is not None:
+            self.loop.remove_timeout(self.timeout)
+            self.timeout = None
+        self.pending = False
+
+
+def obs_auth_response(password, challenge, salt):
+    secret_string = password + salt
+    secret_hash = hashlib.sha256(secret_string.encode('utf-8')).digest()
+    secret = base64.b64encode(secret_hash).decode('utf-8')
+    auth_response_string = secret + challenge
+    auth_response_hash = hashlib.sha256(auth_response_string.encode('utf-8')).digest()
+    return base64.b64encode(auth_response_hash).decode('utf-8')
+
+
+class OBSProtocolV4:
+    subprotocols = None
+    batch_requests = False
+    reidentify_pending = False
+
+    def __init__(self, obs):
+        self.obs = obs
+        # Pre-serialized heads of requests without data, only message-id is appended
+        self.request_templates = {}
+
+    def on_connect(self):
+        self.obs.get_auth_required()
+
+    def update_subscriptions(self):
+        # 4.x sends all events
+        pass
+
+    def encode_request(self, request):
+        if request.data:
+            message = dict()
+            message['request-type'] = request.method
+            message['message-id'] = request.msg_id
+            message.update(request.data)
+            return json_encode(message)
+        template = self.request_templates.get(request.method)
+        if template is None:
+            template = json_encode({'request-type': request.method})[:-1] + ',"message-id":"'
+            self.request_templates[request.method] = template
+        return template + request.msg_id + '"}'
+
+    def decode(self, frame):
+        return [json_decode(frame)]
+
+
+class OBSProtocolV5:
+    # Translates obs-websocket 5.x protocol to messages of 4.x protocol which OBSControl handles
+    HELLO = 0
+    IDENTIFY = 1
+    IDENTIFIED = 2
+    REIDENTIFY = 3
+    EVENT = 5
+    REQUEST = 6
+    REQUEST_RESPONSE = 7
+    REQUEST_BATCH = 8
+    REQUEST_BATCH_RESPONSE = 9
+
+    SUBSCRIPTION_CONFIG = 1 << 1
+    SUBSCRIPTION_SCENES = 1 << 2
+    SUBSCRIPTION_INPUTS = 1 << 3
+    SUBSCRIPTION_TRANSITIONS = 1 << 4
+    SUBSCRIPTION_OUTPUTS = 1 << 6
+    SUBSCRIPTION_SCENE_ITEMS = 1 << 7
+
+    OUTPUT_STATES = {
+        'OBS_WEBSOCKET_OUTPUT_STARTING': STARTING,
+        'OBS_WEBSOCKET_OUTPUT_STARTED': STARTED,
+        'OBS_WEBSOCKET_OUTPUT_STOPPING': STOPPING,
+        'OBS_WEBSOCKET_OUTPUT_STOPPED': STOPPED,
+    }
+
+    batch_requests = True
+
+    def __init__(self, obs):
+        self.obs = obs
+        self.binary = False
+        self.batches = {}
+        # Event subscriptions sent in Identify or Reidentify of current session
+        self.subscriptions = None
+        # Reidentify waits for space in write queue
+        self.reidentify_pending = False
+        self.subprotocols = ['obswebsocket.json']
+        self.msgpack = import_optional('msgpack') if obs.settings.msgpack else None
+        if self.msgpack:
+            self.subprotocols.insert(0, 'obswebsocket.msgpack')
+        # 4.x request -> (5.x requests builder, 5.x responses data translator)
+        self.requests = {
+            'GetSceneList': (
+                lambda data: [('GetSceneList', None)],
+                lambda results: {
+                    'current-scene': results[0]['currentProgramSceneName'],
+                    'scenes': self.scene_list(results[0]['scenes']),
+                }),
+            'SetCurrentScene': (
+                lambda data: [('SetCurrentProgramScene', {'sceneName': data['scene-name']})],
+                None),
+            'GetStreamingStatus': (
+                lambda data: [('GetStreamStatus', None), ('GetRecordStatus', None)],
+                lambda results: {
+                    'streaming': results[0]['outputActive'],
+                    'recording': results[1]['outputActive'],
+                }),
+            'StartStopStreaming': (lambda data: [('ToggleStream', None)], None),
+            'StartStopRecording': (lambda data: [('ToggleRecord', None)], None),
+            'GetTransitionList': (
+                lambda data: [('GetSceneTransitionList', None)],
+                lambda results: {
+                    'current-transition': results[0]['currentSceneTransitionName'],
+                    'transitions': [{'name': t['transitionName']} for t in results[0]['transitions']],
+                }),
+            'GetCurrentTransition': (
+                lambda data: [('GetCurrentSceneTransition', None)],
+                lambda results: {
+                    'name': results[0]['transitionName'],
+                    'duration': results[0].get('transitionDuration'),
+                }),
+            'GetSceneItemList': (
+                lambda data: [('GetSceneItemList', {'sceneName': data['sceneName']})],
+                lambda results: {
+                    'sceneItems': [{'itemId': item['sceneItemId'], 'sourceName': item['sourceName'],
+                                    'render': item['sceneItemEnabled']} for item in results[0]['sceneItems']],
+                }),
+            'SetSceneItemRender': (
+                lambda data: [('SetSceneItemEnabled', {
+                    'sceneName': data['scene-name'], 'sceneItemId': data['item']['id'],
+                    'sceneItemEnabled': data['render']})],
+                None),
+            'GetMute': (
+                lambda data: [('GetInputMute', {'inputName': data['source']})],
+                lambda results: {'muted': results[0]['inputMuted']}),
+            'SetMute': (
+                lambda data: [('SetInputMute', {'inputName': data['source'], 'inputMuted': data['mute']})],
+                None),
+            'GetVolume': (
+                lambda data: [('GetInputVolume', {'inputName': data['source']})],
+                lambda results: {'volume': results[0]['inputVolumeMul']}),
+            'SetVolume': (
+                lambda data: [('SetInputVolume', {'inputName': data['source'], 'inputVolumeMul': data['volume']})],
+                None),
+            'SetTransitionDuration': (
+                lambda data: [('SetCurrentSceneTransitionDuration', {'transitionDuration': data['duration']})],
+                None),
+        }
+        # 5.x event -> (subscription, produced 4.x updates, translator)
+        self.events = {
+            'CurrentProgramSceneChanged': (
+                self.SUBSCRIPTION_SCENES, ('SwitchScenes',),
+                lambda data: {'update-type': 'SwitchScenes', 'scene-name': data['sceneName']}),
+            'SceneListChanged': (
+                self.SUBSCRIPTION_SCENES, ('ScenesChanged',),
+                lambda data: {'update-type': 'ScenesChanged', 'scenes': self.scene_list(data['scenes'])}),
+            'CurrentSceneCollectionChanged': (
+                self.SUBSCRIPTION_CONFIG, ('SceneCollectionChanged',),
+                lambda data: {'update-type': 'SceneCollectionChanged'}),
+            'RecordStateChanged': (
+                self.SUBSCRIPTION_OUTPUTS, tuple(RECORDING_UPDATES),
+                lambda data: self.output_update(RECORDING_UPDATES, data)),
+            'StreamStateChanged': (
+                self.SUBSCRIPTION_OUTPUTS, tuple(STREAMING_UPDATES),
+                lambda data: self.output_update(STREAMING_UPDATES, data)),
+            'SceneItemEnableStateChanged': (
+                self.SUBSCRIPTION_SCENE_ITEMS, ('SceneItemVisibilityChanged',),
+                lambda data: {'update-type': 'SceneItemVisibilityChanged', 'scene-name': data['sceneName'],
+                              'item-id': data['sceneItemId'], 'item-visible': data['sceneItemEnabled']}),
+            'SceneItemCreated': (
+                self.SUBSCRIPTION_SCENE_ITEMS, ('SceneItemAdded',),
+                lambda data: {'update-type': 'SceneItemAdded', 'scene-name': data['sceneName'],
+                              'item-name': data['sourceName'], 'item-id': data['sceneItemId']}),
+            'SceneItemRemoved': (
+                self.SUBSCRIPTION_SCENE_ITEMS, ('SceneItemRemoved',),
+                lambda data: {'update-type': 'SceneItemRemoved', 'scene-name': data['sceneName'],
+                              'item-name': data['sourceName'], 'item-id': data['sceneItemId']}),
+            'InputMuteStateChanged': (
+                self.SUBSCRIPTION_INPUTS, ('SourceMuteStateChanged',),
+                lambda data: {'update-type': 'SourceMuteStateChanged', 'sourceName': data['inputName'],
+                              'muted': data['inputMuted']}),
+            'InputNameChanged': (
+                self.SUBSCRIPTION_INPUTS, ('SourceRenamed',),
+                lambda data: {'update-type': 'SourceRenamed', 'previousName': data['oldInputName'],
+                              'newName': data['inputName']}),
+            'SceneNameChanged': (
+                self.SUBSCRIPTION_SCENES, ('SourceRenamed',),
+                lambda data: {'update-type': 'SourceRenamed', 'previousName': data['oldSceneName'],
+                              'newName': data['sceneName']}),
+            'InputRemoved': (
+                self.SUBSCRIPTION_INPUTS, ('SourceDestroyed',),
+                lambda data: {'update-type': 'SourceDestroyed', 'sourceName': data['inputName']}),
+            'InputVolumeChanged': (
+                self.SUBSCRIPTION_INPUTS, ('SourceVolumeChanged',),
+                lambda data: {'update-type': 'SourceVolumeChanged', 'sourceName': data['inputName'],
+                              'volume': data['inputVolumeMul']}),
+            'CurrentSceneTransitionChanged': (
+                self.SUBSCRIPTION_TRANSITIONS, ('SwitchTransition',),
+                lambda data: {'update-type': 'SwitchTransition', 'transition-name': data['transitionName']}),
+            'CurrentSceneTransitionDurationChanged': (
+                self.SUBSCRIPTION_TRANSITIONS, ('TransitionDurationChanged',),
+                lambda data: {'update-type': 'TransitionDurationChanged',
+                              'new-duration': data['transitionDuration']}),
+        }
+
+    @staticmethod
+    def scene_list(scenes):
+        # 5.x counts scenes from the bottom of OBS list, 4.x from the top
+        return [{'name': scene['sceneName']} for scene in sorted(scenes, key=lambda scene: scene['sceneIndex'],
+                                                                 reverse=True)]
+
+    def output_update(self, updates, data):
+        state = self.OUTPUT_STATES.get(data['outputState'])
+        for update_type, update_state in updates.items():
+            if update_state == state:
+                return {'update-type': update_type}
+        return None
+
+    def event_subscriptions(self):
+        subscriptions = 0
+        for category, update_types, translator in self.events.values():
+            if any(update_type in self.obs.update_handlers for update_type in update_types):
+                subscriptions |= category
+        # High-volume input and scene item events are needed only for mapped sources and volume controls
+        mapping = self.obs.midi.mapping
+        if not mapping.sources and not any(control.action == 'volume' for control in mapping.controls):
+            subscriptions &= ~self.SUBSCRIPTION_INPUTS
+        if not any(source.action == 'visibility' for source in mapping.sources):
+            subscriptions &= ~self.SUBSCRIPTION_SCENE_ITEMS
+        return subscriptions
+
+    def update_subscriptions(self):
+        subscriptions = self.event_subscriptions()
+        self.reidentify_pending = False
+        if not self.obs.connected or subscriptions == self.subscriptions:
+            return
+        if not self.obs.ws.writable:
+            self.reidentify_pending = True
+            return
+        self.obs.log.info('Event subscriptions changed, reidentifying')
+        self.subscriptions = subscriptions
+        self.obs.ws.send(self.encode(self.REIDENTIFY, {'eventSubscriptions': subscriptions}))
+
+    def on_connect(self):
+        self.binary = self.obs.ws.selected_subprotocol == 'obswebsocket.msgpack'
+        self.batches.clear()
+        self.subscriptions = None
+        self.reidentify_pending = False
+
+    def encode(self, op, data):
+        message = {'op': op, 'd': data}
+        if self.binary:
+            return self.msgpack.packb(message)
+        return json_encode(message)
+
+    def translate_request(self, request):
+        builder = self.requests.get(request.method)
+        if builder is None:
+            return [(request.method, request.data)]
+        return builder[0](request.data)
+
+    @staticmethod
+    def request_data(request_type, data):
+        request = {'requestType': request_type}
+        if data:
+            request['requestData'] = data
+        return request
+
+    def encode_request(self, request):
+        requests = self.translate_request(request)
+        if len(requests) > 1:
+            return self.encode_batch([request])
+        data = self.request_data(*requests[0])
+        data['requestId'] = request.msg_id
+        return self.encode(self.REQUEST, data)
+
+    def encode_batch(self, requests):
+        batch_id = 'batch-' + requests[0].msg_id
+        layout = []
+        entries = []
+        for request in requests:
+            translated = self.translate_request(request)
+            layout.append((request.msg_id, request.method, len(translated)))
+            entries.extend(self.request_data(*entry) for entry in translated)
+        self.batches[batch_id] = layout
+        return self.encode(self.REQUEST_BATCH, {'requestId': batch_id, 'haltOnFailure': False, 'requests': entries})
+
+    def decode(self, frame):
+        if isinstance(frame, bytes):
+            message = self.msgpack.unpackb(frame, raw=False)
+        else:
+            message = json_decode(frame)
+        op, data = message['op'], message['d']
+        if op == self.EVENT:
+            event = self.events.get(data['eventType'])
+            if event is None:
+                update = {'update-type': data['eventType']}
+                update.update(data.get('eventData') or {})
+                return [update]
+            update = event[2](data.get('eventData') or {})
+            return [update] if update else []
+        elif op == self.REQUEST_RESPONSE:
+            request = self.obs.requests.get(data['requestId'])
+            method = request.method if request else data['requestType']
+            return [self.translate_response(data['requestId'], method, [data])]
+        elif op == self.REQUEST_BATCH_RESPONSE:
+            layout = self.batches.pop(data['requestId'], [])
+            results = data['results']
+            responses = []
+            for msg_id, method, count in layout:
+                responses.append(self.translate_response(msg_id, method, results[:count]))
+                results = results[count:]
+            return responses
+        elif op == self.HELLO:
+            self.identify(data)
+        elif op == self.IDENTIFIED and not self.obs.connected:
+            # Reidentify is confirmed with Identified too, session is already set up then
+            self.obs.process_auth_success(data)
+            # Mapping could be reloaded while Identify was in flight
+            self.update_subscriptions()
+        return []
+
+    def translate_response(self, msg_id, method, results):
+        for result in results:
+            status = result['requestStatus']
+            if not status['result']:
+                return {'message-id': msg_id, 'status': 'error',
+                        'error': status.get('comment') or 'error code {0}'.format(status['code'])}
+        translator = self.requests.get(method, (None, None))[1]
+        datas = [result.get('responseData') or {} for result in results]
+        resp = translator(datas) if translator else dict(datas[0]) if datas else {}
+        resp['message-id'] = msg_id
+        resp['status'] = 'ok'
+        return resp
+
+    def identify(self, hello):
+        if not self.obs.ws.writable:
+            self.obs.log.error('Websocket write queue is full, Identify not sent, reconnecting')
+            self.obs.ws.close()
+            return
+        self.obs.log.info('Identifying to obs-websocket {0}'.format(hello.get('obsWebSocketVersion')))
+        self.subscriptions = self.event_subscriptions()
+        data = {'rpcVersion': 1, 'eventSubscriptions': self.subscriptions}
+        if 'authentication' in hello:
+            data['authentication'] = obs_auth_response(
+                self.obs.password or '', hello['authentication']['challenge'], hello['authentication']['salt'])
+        self.obs.ws.send(self.encode(self.IDENTIFY, data))
+
+
+OBS_PROTOCOLS = {
+    '4': OBSProtocolV4,
+    '5': OBSProtocolV5,
+}
+
+
+class OBSSceneRegistry:
+    def __init__(self):
+        self.names = []
+        self.indexes = {}
+        self.current_index = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def current_name(self):
+        if self.current_index is None:
+            return None
+        return self.names[self.current_index]
+
+    def index_of(self, name):
+        return self.indexes.get(name)
+
+    def name_at(self, index):
+        if 0 <= index < len(self.names):
+            return self.names[index]
+        return None
+
+    # load and switch return indexes of scenes which LED state has changed
+    def load(self, names, current_name):
+        old_count, old_current = len(self.names), self.current_index
+        self.names = list(names)
+        self.indexes = {name: index for index, name in enumerate(self.names)}
+        self.current_index = self.indexes.get(current_name)
+        changed = set(range(min(old_count, len(self.names)), max(old_count, len(self.names))))
+        if old_current != self.current_index:
+            changed.update(i for i in (old_current, self.current_index) if i is not None)
+        return changed
+
+    def switch(self, name):
+        index = self.indexes.get(name)
+        if index is None:
+            return None
+        changed = {i for i in (self.current_index, index) if i is not None}
+        self.current_index = index
+        return changed
+
+
+class OBSSceneItem:
+    def __init__(self, item_id, source, visible):
+        self.item_id = item_id
+        self.source = source
+        self.visible = visible
+
+
+class OBSSceneItemCache:
+    # Scene items by scene and source name and mute state by source name, kept in sync by OBS events
+    def __init__(self):
+        self.scenes = {}
+        self.muted = {}
+        self.volumes = {}
+
+    def clear(self):
+        self.scenes.clear()
+        self.muted.clear()
+        self.volumes.clear()
+
+    def load_scene(self, scene, items):
+        self.scenes[scene] = {item.source: item for item in items}
+
+    def retain_scenes(self, names):
+        for scene in set(self.scenes) - set(names):
+            del self.scenes[scene]
+
+    def get_item(self, scene, source):
+        return self.scenes.get(scene, {}).get(source)
+
+    def find_item(self, scene, item_id):
+        for item in self.scenes.get(scene, {}).values():
+            if item.item_id == item_id:
+                return item
+        return None
+
+    def add_item(self, scene, item):
+        if scene in self.scenes:
+            self.scenes[scene][item.source] = item
+
+    def remove_item(self, scene, item_id):
+        item = self.find_item(scene, item_id)
+        if item is not None:
+            del self.scenes[scene][item.source]
+
+    def rename(self, old_name, new_name):
+        # Scenes are sources too
+        if old_name in self.scenes:
+            self.scenes[new_name] = self.scenes.pop(old_name)
+        for states in (self.muted, self.volumes):
+            if old_name in states:
+                states[new_name] = states.pop(old_name)
+        for items in self.scenes.values():
+            item = items.pop(old_name, None)
+            if item is not None:
+                item.source = new_name
+                items[new_name] = item
+
+    def forget(self, name):
+        self.scenes.pop(name, None)
+        self.muted.pop(name, None)
+        self.volumes.pop(name, None)
+        for items in self.scenes.values():
+            items.pop(name, None)
+
+
 class OBSControl:
-    def __init__(self, host, port, password=None):
-        log.info('=== START ===')
-        self.ws = OBSWebSocketClient()
-        self.ws.connect('ws://{0}:{1}'.format(host, port))
-        self.midi = MIDIControl()
-        self.password = password
-        self.scenes = []
-        self.current_scene = None
+    ws_class = None
+    midi_class = MIDIControl
+
+    def __init__(self, settings, profile=None):
+        self.settings = settings
+        self.name = settings.name
+        self.log = BridgeLog(log, {'bridge': settings.name})
+        self.log.info('=== START ===')
+        self.profile = profile
+        self.last_led_frame = None
+        self.metrics = Metrics(settings.name)
+        self.capture = ProtocolCapture(settings.capture_size, settings.dump_midi_proto, settings.dump_websockets_proto,
+                                       settings.trace_file, settings.name, self.log)
+        self.protocol = OBS_PROTOCOLS[settings.protocol](self)
+        self.ws = self.ws_class(self, subprotocols=self.protocol.subprotocols)
+        self.ws.connect('ws://{0}:{1}'.format(settings.host, settings.port))
+        self.midi = self.midi_class(self)
+        self.password = settings.password
+        # Futures of state queries sent along with handshake
+        self.state_requests = None
+        self.scenes = OBSSceneRegistry()
+        self.scene_items = OBSSceneItemCache()
+        # Keys of prefetch_sources requests waiting for response
+        self.source_fetches = set()
         self.transitions = []
         self.current_transition = None
         self.current_transition_duration = None
         self.streaming_state = STOPPED
         self.recording_state = STOPPED
+        # In-flight requests by message-id, requests over max_pending_requests wait in backlog
+        self.request_ids = itertools.count(1)
+        self.requests = {}
+        self.request_backlog = deque()
+        self.request_backlog_size = settings.request_backlog_size
+        self.request_timeout = settings.request_timeout
+        self.max_pending_requests = settings.max_pending_requests
+        # Requests made while OBS is not connected are dropped or held until state is resynced
+        self.connected = False
+        self.initialized = False
+        self.offline_policy = settings.offline_requests
+        self.offline_requests = deque()
+        self.offline_queue_size = settings.offline_queue_size
+        # Only the newest waiting request of these methods is sent, toggles must never be collapsed
+        # method -> handler of superseded request
+        self.collapsed_methods = {'SetCurrentScene': self.scene_superseded}
+        self.requests_collapsed = 0
+        self.requests_dropped = 0
+        self.last_recovery_time = None
+        # Optimistic LED state shown until OBS confirms it: 'scene', 'record', 'stream' -> OBSPrediction
+        self.optimistic = settings.optimistic_leds
+        self.optimistic_timeout = settings.optimistic_timeout
+        self.predictions = {}
+        self.predictions_confirmed = 0
+        self.predictions_rolled_back = 0
+        # Continuous controls: (action, source) -> OBSThrottle
+        self.control_throttles = {}
+        self.control_interval = 1 / settings.control_rate
+        self.requests_sent = 0
+        self.request_errors = 0
+        self.request_timeouts = 0
+        self.updates_received = 0
+        for name, metric_type, help_text, getter in (
+                ('obs_connected', 'gauge', 'OBS session is connected and authorized', lambda: int(self.connected)),
+                ('obs_requests_in_flight', 'gauge', 'OBS requests waiting for response', lambda: len(self.requests)),
+                ('obs_requests_backlog', 'gauge', 'OBS requests waiting to be sent',
+                 lambda: len(self.request_backlog) + len(self.offline_requests)),
+                ('obs_requests_total', 'counter', 'OBS requests sent', lambda: self.requests_sent),
+                ('obs_requests_collapsed_total', 'counter', 'Waiting OBS requests superseded by newer ones',
+                 lambda: self.requests_collapsed),
+                ('obs_requests_dropped_total', 'counter', 'Waiting OBS requests dropped by full backlog',
+                 lambda: self.requests_dropped),
+                ('ws_write_queue_depth', 'gauge', 'Websocket frames waiting for socket write',
+                 lambda: len(self.ws.write_queue)),
+                ('obs_request_errors_total', 'counter', 'OBS requests failed', lambda: self.request_errors),
+                ('obs_request_timeouts_total', 'counter', 'OBS requests timed out', lambda: self.request_timeouts),
+                ('obs_updates_total', 'counter', 'OBS update events received', lambda: self.updates_received),
+                ('obs_reconnects_total', 'counter', 'Successful reconnects to OBS', lambda: self.ws.reconnects),
+                ('led_predictions_confirmed_total', 'counter', 'Optimistic LED states confirmed by OBS',
+                 lambda: self.predictions_confirmed),
+                ('led_predictions_rolled_back_total', 'counter', 'Optimistic LED states rolled back',
+                 lambda: self.predictions_rolled_back),
+                ('control_requests_total', 'counter', 'OBS requests sent by continuous controls',
+                 lambda: sum(throttle.sent for throttle in self.control_throttles.values())),
+                ('control_values_skipped_total', 'counter', 'Continuous control values replaced before sending',
+                 lambda: sum(throttle.skipped for throttle in self.control_throttles.values()))):
+            self.metrics.collect(name, metric_type, help_text, getter)
+        self.update_handlers = {}
+        self.register_update_handler('SwitchScenes', self.on_switch_scenes)
+        self.register_update_handler('ScenesChanged', self.on_scenes_changed)
+        self.register_update_handler('SceneCollectionChanged', self.on_scene_collection_changed)
+        self.register_update_handler('SceneItemVisibilityChanged', self.on_scene_item_visibility)
+        self.register_update_handler('SceneItemAdded', self.on_scene_item_added)
+        self.register_update_handler('SceneItemRemoved', self.on_scene_item_removed)
+        self.register_update_handler('SourceMuteStateChanged', self.on_source_mute)
+        self.register_update_handler('SourceRenamed', self.on_source_renamed)
+        self.register_update_handler('SourceDestroyed', self.on_source_destroyed)
+        self.register_update_handler('SourceVolumeChanged', self.on_source_volume)
+        self.register_update_handler('TransitionDurationChanged', self.on_transition_duration)
+        self.register_update_handler('SwitchTransition', self.on_switch_transition)
+        for update_type, state in RECORDING_UPDATES.items():
+            self.register_update_handler(update_type, functools.partial(self.on_recording_state, state))
+        for update_type, state in STREAMING_UPDATES.items():
+            self.register_update_handler(update_type, functools.partial(self.on_streaming_state, state))
+
+    def register_update_handler(self, update_type, handler):
+        self.update_handlers[update_type] = handler
+
+    def new_request(self, method, data=None, callback=None, errback=None):
+        origin = self.metrics.origin
+        if origin is not None and origin[0] != 'press':
+            origin = None
+        return OBSRequest(str(next(self.request_ids)), method, data, callback, errback, origin)
+
+    def send_request(self, method, data=None, callback=None, errback=None):
+        request = self.new_request(method, data, callback, errback)
+        if not self.connected:
+            self.hold_request(request)
+        elif self.can_write():
+            self.write_request(request)
+        else:
+            if self.settings.debug:
+                self.log.debug('Request {0} postponed'.format(method))
+            self.backlog_request(request)
+        return request.future
+
+    def can_write(self):
+        # Requests wait in backlog while OBS has too many of them or socket doesn't keep up with writes
+        return len(self.requests) < self.max_pending_requests and self.ws.writable
+
+    def backlog_request(self, request):
+        self.collapse_requests(self.request_backlog, request)
+        if len(self.request_backlog) >= self.request_backlog_size:
+            dropped = self.request_backlog.popleft()
+            self.requests_dropped += 1
+            self.log.warning('Request backlog is full, request {0} dropped'.format(dropped.method))
+            self.fail_request(dropped, OBSRequestError('Request backlog is full'))
+        self.request_backlog.append(request)
+
+    def collapse_requests(self, queue, request):
+        superseded_handler = self.collapsed_methods.get(request.method)
+        if superseded_handler is None:
+            return
+        superseded = [old for old in queue if old.method == request.method]
+        for old in superseded:
+            queue.remove(old)
+            self.requests_collapsed += 1
+            if self.settings.debug:
+                self.log.debug('Request {0} superseded'.format(old.method))
+            self.fail_request(old, OBSRequestError('{0} superseded'.format(old.method)))
+            superseded_handler(old)
+
+    def scene_superseded(self, request):
+        # Pad of scene which will not be switched to stops its pending or transition animation
+        index = self.scenes.index_of(request.data['scene-name'])
+        scene = self.midi.mapping.get_scene_mapping_by_index(index)
+        if scene:
+            self.midi.animator.cancel(self.midi.led_address(scene.inactive))
+            self.midi.send_scenes_state([index])
+
+    def send_batch(self, requests):
+        # Sends list of (method, data, callback) at once, as RequestBatch if protocol supports it
+        if not self.connected or not self.protocol.batch_requests or not self.ws.writable:
+            return [self.send_request(method, data, callback) for method, data, callback in requests]
+        batch = [self.new_request(method, data, callback) for method, data, callback in requests]
+        for request in batch:
+            self.register_request(request)
+        self.write_frame(self.protocol.encode_batch(batch))
+        return [request.future for request in batch]
+
+    def register_request(self, request):
+        request.sent_at = time.perf_counter()
+        self.requests_sent += 1
+        self.metrics.observe('request_queue_seconds', request.sent_at - request.created_at)
+        if request.origin is not None:
+            self.metrics.observe('press_to_request_seconds', request.sent_at - request.origin[1])
+        self.requests[request.msg_id] = request
+        request.timeout = ioloop.IOLoop.current().call_later(self.request_timeout, self.expire_request, request)
+
+    def write_request(self, request):
+        self.register_request(request)
+        self.write_frame(self.protocol.encode_request(request))
+
+    def write_frame(self, frame):
+        self.ws.send(frame)
+        if self.settings.debug:
+            self.log.debug('Request sent')
+        if self.capture.websockets:
+            self.capture.add('ws-out', frame)
+
+    def hold_request(self, request):
+        if self.offline_policy == 'queue':
+            self.collapse_requests(self.offline_requests, request)
+        if self.offline_policy == 'queue' and len(self.offline_requests) < self.offline_queue_size:
+            self.log.info('OBS is not connected, request {0} queued'.format(request.method))
+            self.offline_requests.append(request)
+        else:
+            self.log.warning('OBS is not connected, request {0} dropped'.format(request.method))
+            self.fail_request(request, OBSRequestError('OBS is not connected'))
+
+    def on_connect(self):
+        if self.capture.websockets:
+            self.capture.add('ws-state', 'open')
+        self.profile_mark('websocket connected')
+        self.protocol.on_connect()
+
+    def profile_mark(self, stage):
+        if self.profile is not None:
+            self.profile.mark(stage)
+
+    def profile_led_frame(self):
+        self.last_led_frame = time.perf_counter()
+        if self.initialized:
+            self.finish_profile()
+
+    def finish_profile(self):
+        self.profile.mark('first LED frame', self.last_led_frame)
+        self.profile.report(self.log)
+        self.profile = None
+
+    def on_disconnect(self):
+        if self.capture.websockets:
+            self.capture.add('ws-state', 'closed')
+        self.connected = False
+        error = OBSRequestError('Connection lost')
+        for request in self.requests.values():
+            ioloop.IOLoop.current().remove_timeout(request.timeout)
+            self.fail_request(request, error)
+        self.requests.clear()
+        backlog, self.request_backlog = self.request_backlog, deque()
+        for request in backlog:
+            self.hold_request(request)
+
+    def send_offline_requests(self):
+        requests, self.offline_requests = self.offline_requests, deque()
+        for request in requests:
+            if self.can_write():
+                self.write_request(request)
+            else:
+                self.backlog_request(request)
 
-    def send_request(self, method, msg_id=None, data=None):
-        request = dict()
-        request['request-type'] = method
-        if msg_id:
-            request['message-id'] = msg_id
-        if data:
-            request.update(data)
-            # request = {**request, **data}
-        result = json.dumps(request, indent='\t')
-        self.ws.send(result)
-        log.debug('Request sent')
-        if Config.getboolean('OBS_Control', 'dump_websockets_proto', fallback=False):
-            print(result)
-
-    def process_response(self, resp):
-        log.debug('Response received')
-        if Config.getboolean('OBS_Control', 'dump_websockets_proto', fallback=False):
-            print(resp)
-        resp = json.loads(resp)
-        if 'status' in resp.keys():
-            if resp['status'] == 'error':
-                log.error('OBS said: ' + resp['error'])
-        if 'message-id' in resp.keys():
+    def expire_request(self, request):
+        self.log.error('Request {0} timed out'.format(request.method))
+        self.request_timeouts += 1
+        del self.requests[request.msg_id]
+        self.fail_request(request, OBSRequestTimeout('{0} timed out'.format(request.method)))
+        self.send_request_backlog()
+
+    def send_request_backlog(self):
+        while self.request_backlog and self.can_write():
+            self.write_request(self.request_backlog.popleft())
+
+    # Continuations run right away, so they are applied in order with updates of the same frame
+    @staticmethod
+    def complete_request(request, resp):
+        request.future.set_result(resp)
+        if request.callback:
+            request.callback(resp)
+
+    @staticmethod
+    def fail_request(request, error):
+        request.future.set_exception(error)
+        # Failure is handled here, don't report it as never retrieved
+        request.future.exception()
+        if request.errback:
+            request.errback(error)
+
+    def process_response(self, frame):
+        if self.settings.debug:
+            self.log.debug('Response received')
+        if self.capture.websockets:
+            self.capture.add('ws-in', frame)
+        self.metrics.origin = ('event', time.perf_counter())
+        for resp in self.protocol.decode(frame):
+            self.process_message(resp)
+        self.metrics.origin = None
+
+    def process_message(self, resp):
+        if resp.get('status') == 'error':
+            self.log.error('OBS said: ' + resp['error'])
+        if 'message-id' in resp:
             self.process_message_id(resp)
-        if 'update-type' in resp.keys():
+        if 'update-type' in resp:
             self.process_update(resp)
 
     def process_message_id(self, resp):
-        if resp['message-id'] == 'AUTH_REQ':
-            if resp['authRequired']:
-                self.authenticate(self.password, resp['challenge'], resp['salt'])
-            else:
-                self.init_state()
-        elif resp['message-id'] == 'AUTH_TRY':
-            if resp['status'] == 'ok':
-                self.init_state()
-            else:
-                self.exit()
-        elif resp['message-id'] == 'SCENE_LIST':
-            self.update_scene_list(resp)
-        elif resp['message-id'] == 'SET_SCENE':
-            self.midi.send_scene_pending_state(self.get_current_scene_index())
-        elif resp['message-id'] == 'STREAM_RECORD_STATUS':
-            self.update_stream_record_status(resp)
-        elif resp['message-id'] == 'GET_TRANSITION_LIST':
-            self.update_transition_list(resp)
-        elif resp['message-id'] == '':
-            pass
+        request = self.requests.pop(resp['message-id'], None)
+        if request is None:
+            self.log.warning('Unhandled message: {0}'.format(resp))
+            return
+        ioloop.IOLoop.current().remove_timeout(request.timeout)
+        self.metrics.observe('obs_response_seconds', time.perf_counter() - request.sent_at)
+        if resp.get('status') == 'error':
+            self.request_errors += 1
+            self.fail_request(request, OBSRequestError(resp['error'], resp))
         else:
-            log.warning('Unhandled message')
-            if not Config.getboolean('OBS_Control', 'dump_websockets_proto', fallback=False):
-                print(resp)
+            self.complete_request(request, resp)
+        self.send_request_backlog()
 
     def process_update(self, resp):
-        log.info('Processing update')
-        if resp['update-type'] == 'SwitchScenes':
-            self.current_scene = resp['scene-name']
-            self.midi.send_scenes_state()
-        elif resp['update-type'] == 'ScenesChanged':
+        self.log.info('Processing update')
+        self.updates_received += 1
+        handler = self.update_handlers.get(resp['update-type'])
+        if handler is None:
+            self.log.warning('Unhandled message: {0}'.format(resp))
+            return
+        handler(resp)
+
+    def on_switch_scenes(self, resp):
+        changed = self.scenes.switch(resp['scene-name'])
+        if changed is None:
+            self.log.warning('Switched to unknown scene {0}, resyncing'.format(resp['scene-name']))
+            self.rollback('scene', self.predictions.get('scene'), 'unknown scene')
             self.get_scene_list()
-        elif resp['update-type'] == 'RecordingStarting':
-            self.recording_state = STARTING
-        elif resp['update-type'] == 'RecordingStarted':
-            self.recording_state = STARTED
-        elif resp['update-type'] == 'RecordingStopping':
-            self.recording_state = STOPPING
-        elif resp['update-type'] == 'RecordingStopped':
-            self.recording_state = STOPPED
-        elif resp['update-type'] == 'StreamStarting':
-            self.streaming_state = STARTING
-        elif resp['update-type'] == 'StreamStarted':
-            self.streaming_state = STARTED
-        elif resp['update-type'] == 'StreamStopping':
-            self.streaming_state = STOPPING
-        elif resp['update-type'] == 'StreamStopped':
-            self.streaming_state = STOPPED
-        else:
-            log.warning('Unhandled message')
-            if not Config.getboolean('OBS_Control', 'dump_websockets_proto', fallback=False):
-                print(resp)
+            return
+        self.reconcile('scene', self.scenes.current_index)
+        self.midi.send_scenes_state(changed)
+        self.midi.send_sources_state()
+        self.prefetch_sources()
+
+    def on_scenes_changed(self, resp):
+        current_name = self.scenes.current_name
+        if 'scenes' not in resp or current_name not in (scene['name'] for scene in resp['scenes']):
+            self.get_scene_list()
+            return
+        self.midi.send_scenes_state(self.scenes.load((scene['name'] for scene in resp['scenes']), current_name))
+        self.update_scene_items(resp['scenes'])
+
+    def on_scene_collection_changed(self, resp):
+        self.scene_items.clear()
+        self.get_scene_list()
+
+    def on_scene_item_visibility(self, resp):
+        item = self.scene_items.find_item(resp['scene-name'], resp['item-id'])
+        if item is not None:
+            item.visible = resp['item-visible']
+            self.midi.send_sources_state()
+
+    def on_scene_item_added(self, resp):
+        # New scene items are visible
+        self.scene_items.add_item(resp['scene-name'], OBSSceneItem(resp['item-id'], resp['item-name'], True))
+        self.midi.send_sources_state()
+
+    def on_scene_item_removed(self, resp):
+        self.scene_items.remove_item(resp['scene-name'], resp['item-id'])
+        self.midi.send_sources_state()
+
+    def on_source_mute(self, resp):
+        self.scene_items.muted[resp['sourceName']] = resp['muted']
+        self.midi.send_sources_state()
+
+    def on_source_renamed(self, resp):
+        self.scene_items.rename(resp['previousName'], resp['newName'])
+        self.midi.send_sources_state()
+        self.midi.send_controls_state()
+
+    def on_source_destroyed(self, resp):
+        self.scene_items.forget(resp['sourceName'])
+        self.midi.send_sources_state()
+
+    def on_source_volume(self, resp):
+        self.scene_items.volumes[resp['sourceName']] = resp['volume']
+        self.midi.send_controls_state()
+
+    def on_switch_transition(self, resp):
+        self.current_transition = resp['transition-name']
+        if self.midi.mapping.uses_transition_duration:
+            self.get_current_transition()
+
+    def transition_duration(self):
+        if self.current_transition_duration is None:
+            return None
+        return self.current_transition_duration / 1000
+
+    def on_transition_duration(self, resp):
+        self.current_transition_duration = resp['new-duration']
+        self.midi.send_controls_state()
+
+    def on_recording_state(self, state, resp):
+        self.recording_state = state
+        self.reconcile('record', state)
         self.midi.send_record_state()
+
+    def on_streaming_state(self, state, resp):
+        self.streaming_state = state
+        self.reconcile('stream', state)
         self.midi.send_stream_state()
 
+    def displayed_state(self, kind, actual):
+        prediction = self.predictions.get(kind)
+        return actual if prediction is None else prediction.value
+
+    def predict(self, kind, value, accepts=()):
+        # Returns errback rolling the prediction back if its request fails
+        old = self.predictions.get(kind)
+        accepts = set(accepts)
+        if old is not None:
+            ioloop.IOLoop.current().remove_timeout(old.timeout)
+            accepts |= old.accepts
+            accepts.add(old.value)
+        origin = self.metrics.origin
+        pressed_at = origin[1] if origin is not None and origin[0] == 'press' else time.perf_counter()
+        prediction = OBSPrediction(value, pressed_at, accepts)
+        prediction.timeout = ioloop.IOLoop.current().call_later(
+            self.optimistic_timeout, self.rollback, kind, prediction, 'no confirmation from OBS')
+        self.predictions[kind] = prediction
+        return functools.partial(self.rollback, kind, prediction)
+
+    def reconcile(self, kind, value):
+        prediction = self.predictions.get(kind)
+        if prediction is None or value in prediction.accepts:
+            return
+        if value != prediction.value:
+            self.rollback(kind, prediction, 'OBS state is {0}'.format(value))
+            return
+        del self.predictions[kind]
+        ioloop.IOLoop.current().remove_timeout(prediction.timeout)
+        self.predictions_confirmed += 1
+        confirmed_in = time.perf_counter() - prediction.pressed_at
+        self.metrics.observe('press_to_confirm_seconds', confirmed_in)
+        self.log.info('Predicted {0} state confirmed in {1:.1f}ms'.format(kind, confirmed_in * 1000))
+
+    def rollback(self, kind, prediction, reason):
+        if prediction is None or self.predictions.get(kind) is not prediction:
+            return
+        del self.predictions[kind]
+        ioloop.IOLoop.current().remove_timeout(prediction.timeout)
+        self.predictions_rolled_back += 1
+        self.log.warning('Predicted {0} state rolled back: {1}'.format(kind, reason))
+        if kind == 'scene':
+            self.midi.send_scenes_state()
+        elif kind == 'record':
+            self.midi.send_record_state()
+        else:
+            self.midi.send_stream_state()
+
+    def predict_toggle(self, kind, actual):
+        shown = self.displayed_state(kind, actual)
+        if shown == STOPPED:
+            return self.predict(kind, STARTED, (STARTING,))
+        elif shown == STARTED:
+            return self.predict(kind, STOPPED, (STOPPING,))
+        return None
+
+    def write_handshake(self, request):
+        # Handshake requests go out before session is ready for other requests, but within write queue limit
+        if not self.ws.writable:
+            self.log.error('Websocket write queue is full, {0} not sent, reconnecting'.format(request.method))
+            self.ws.close()
+            return False
+        self.write_request(request)
+        return True
+
     def get_auth_required(self):
-        self.send_request('GetAuthRequired', 'AUTH_REQ')
+        self.state_requests = None
+        if not self.write_handshake(self.new_request('GetAuthRequired', callback=self.process_auth_required)):
+            return
+        if not self.password:
+            # OBS without password is unlikely to require auth, state is queried in the same round trip
+            self.state_requests = self.request_state(pipelined=True)
+
+    def process_auth_required(self, resp):
+        if resp['authRequired']:
+            self.state_requests = None
+            self.authenticate(self.password, resp['challenge'], resp['salt'])
+        else:
+            self.process_auth_success(resp)
 
     def authenticate(self, password, challenge, salt):
-        log.info('Trying authorize...')
-        secret_string = password + salt
-        secret_hash = hashlib.sha256(secret_string.encode('utf-8')).digest()
-        secret = base64.b64encode(secret_hash).decode('utf-8')
-        auth_response_string = secret + challenge
-        auth_response_hash = hashlib.sha256(auth_response_string.encode('utf-8')).digest()
-        auth_response = base64.b64encode(auth_response_hash).decode('utf-8')
-        self.send_request('Authenticate', 'AUTH_TRY', {'auth': auth_response})
+        self.log.info('Trying authorize...')
+        self.write_handshake(self.new_request('Authenticate', {'auth': obs_auth_response(password, challenge, salt)},
+                                              callback=self.process_auth_success, errback=self.process_auth_error))
+
+    def process_auth_success(self, resp):
+        self.log.info('Authorized')
+        self.profile_mark('authorized')
+        self.connected = True
+        self.init_state()
+
+    def process_auth_error(self, error):
+        self.log.critical('Authorization failed: {0}'.format(error))
+        self.stop()
+
+    def request_state(self, pipelined=False):
+        # First sync and resync after reconnect repaint whole controller, it could be power-cycled meanwhile
+        self.midi.invalidate_led_state()
+        queries = [
+            ('GetSceneList', None, functools.partial(self.update_scene_list, True)),
+            ('GetTransitionList', None, self.update_transition_list),
+            ('GetStreamingStatus', None, self.update_stream_record_status),
+        ]
+        if not pipelined:
+            return self.send_batch(queries)
+        if self.ws.write_queue_size - len(self.ws.write_queue) < len(queries):
+            # Queries don't fit into write queue along with handshake, they are sent after it
+            return None
+        requests = [self.new_request(method, data, callback) for method, data, callback in queries]
+        for request in requests:
+            self.write_request(request)
+        return [request.future for request in requests]
 
+    @gen.coroutine
     def init_state(self):
-        log.info('Loading init state')
-        self.get_scene_list()
-        self.get_transition_list()
-        self.get_stream_record_status()
-
-    def get_scene_list(self):
-        log.info('Getting scene list')
-        self.send_request('GetSceneList', 'SCENE_LIST')
+        self.log.info('Loading init state')
+        state, self.state_requests = self.state_requests, None
+        if state is None:
+            state = self.request_state()
+        try:
+            yield state
+        except OBSRequestError as e:
+            self.log.error('Loading init state failed: {0}'.format(e))
+            return
+        self.profile_mark('state loaded')
+        self.initialized = True
+        if self.profile is not None and self.last_led_frame is not None and not self.midi.out_buffer:
+            # LEDs of loaded state were flushed while responses were processed
+            self.finish_profile()
+        recovery_time = self.ws.recovered()
+        if recovery_time is not None:
+            self.last_recovery_time = recovery_time
+            self.log.info('OBS state recovered in {0:.3f}s'.format(recovery_time))
+        self.send_offline_requests()
+
+    def get_scene_list(self, full=False):
+        self.log.info('Getting scene list')
+        return self.send_request('GetSceneList', callback=functools.partial(self.update_scene_list, full))
 
     def get_current_scene_index(self):
-        log.debug('Getting current scene index')
-        for scene in self.scenes:
-            if self.current_scene == scene['name']:
-                return self.scenes.index(scene)
-
-    def update_scene_list(self, resp):
-        log.info('Updating scene list')
-        self.scenes = resp['scenes']
-        self.current_scene = resp['current-scene']
-        self.midi.send_scenes_state()
-
-    def set_current_scene(self, name):
-        log.info('Setting scene {0}'.format(name))
-        self.send_request('SetCurrentScene', 'SET_SCENE', {'scene-name': name})
+        return self.scenes.current_index
+
+    def update_scene_list(self, full, resp):
+        self.log.info('Updating scene list')
+        changed = self.scenes.load((scene['name'] for scene in resp['scenes']), resp['current-scene'])
+        self.midi.send_scenes_state(None if full else changed)
+        self.update_scene_items(resp['scenes'])
+
+    def update_scene_items(self, scenes):
+        # 4.x scene list carries scene items, 5.x items are fetched per scene by prefetch_sources
+        self.scene_items.retain_scenes(scene['name'] for scene in scenes)
+        for scene in scenes:
+            if 'sources' in scene:
+                self.scene_items.load_scene(scene['name'], (
+                    OBSSceneItem(item['id'], item['name'], item.get('render', True)) for item in scene['sources']))
+                for item in scene['sources']:
+                    if 'muted' in item:
+                        self.scene_items.muted[item['name']] = item['muted']
+        self.midi.send_sources_state()
+        self.prefetch_sources()
+
+    def source_scene(self, source):
+        if source.scene_index is None:
+            return self.scenes.current_name
+        return self.scenes.name_at(source.scene_index)
+
+    def source_state(self, source):
+        # True if source is visible or unmuted, None if it is not known
+        if source.action == 'mute':
+            muted = self.scene_items.muted.get(source.source)
+            return None if muted is None else not muted
+        item = self.scene_items.get_item(self.source_scene(source), source.source)
+        return None if item is None else item.visible
+
+    def prefetch_sources(self):
+        # Resolves mapped sources missing in cache with single batch
+        if not self.connected:
+            return
+        requests = OrderedDict()
+        for source in self.midi.mapping.sources:
+            if source.action == 'mute':
+                if source.source not in self.scene_items.muted:
+                    requests[('GetMute', source.source)] = (
+                        'GetMute', {'source': source.source}, functools.partial(self.update_mute, source.source))
+            else:
+                scene = self.source_scene(source)
+                if scene is not None and scene not in self.scene_items.scenes:
+                    requests[('GetSceneItemList', scene)] = (
+                        'GetSceneItemList', {'sceneName': scene}, functools.partial(self.update_item_list, scene))
+        for control in self.midi.mapping.controls:
+            if control.action == 'volume' and control.source not in self.scene_items.volumes:
+                requests[('GetVolume', control.source)] = (
+                    'GetVolume', {'source': control.source}, functools.partial(self.update_volume, control.source))
+        if self.current_transition_duration is None and self.midi.mapping.uses_transition_duration:
+            requests[('GetCurrentTransition',)] = ('GetCurrentTransition', None, self.update_current_transition)
+        for key in self.source_fetches.intersection(requests):
+            del requests[key]
+        if requests:
+            self.log.info('Fetching {0} scene items lists and mute states'.format(len(requests)))
+            self.source_fetches.update(requests)
+            for key, future in zip(requests, self.send_batch(list(requests.values()))):
+                future.add_done_callback(functools.partial(self.source_fetch_done, key))
+
+    def source_fetch_done(self, key, future):
+        self.source_fetches.discard(key)
+
+    def update_mute(self, source, resp):
+        self.scene_items.muted[source] = resp['muted']
+        self.midi.send_sources_state()
+
+    def update_volume(self, source, resp):
+        self.scene_items.volumes[source] = resp['volume']
+        self.midi.send_controls_state()
+
+    def update_item_list(self, scene, resp):
+        self.scene_items.load_scene(scene, (
+            OBSSceneItem(item['itemId'], item['sourceName'], item.get('render', True)) for item in resp['sceneItems']))
+        self.midi.send_sources_state()
+
+    def control_state(self, control):
+        if control.action == 'volume':
+            return self.scene_items.volumes.get(control.source)
+        return self.current_transition_duration
+
+    def control_busy(self, control):
+        # OBS events about value being changed by fader are not echoed back to it
+        throttle = self.control_throttles.get(control.target)
+        return throttle is not None and throttle.busy
+
+    def set_control(self, control, value):
+        throttle = self.control_throttles.get(control.target)
+        if throttle is None:
+            # Changes made in OBS while fader was moving are shown when it settles
+            throttle = OBSThrottle(self.control_interval, functools.partial(self.send_control, *control.target),
+                                   self.midi.send_controls_state)
+            self.control_throttles[control.target] = throttle
+        throttle.set(value)
+
+    def send_control(self, action, source, value):
+        if self.settings.debug:
+            self.log.debug('Setting {0} {1} to {2}'.format(action, source, value))
+        if action == 'volume':
+            return self.send_request('SetVolume', {'source': source, 'volume': value})
+        duration = max(int(round(value)), MIN_TRANSITION_DURATION)
+        return self.send_request('SetTransitionDuration', {'duration': duration})
+
+    def source_toggle(self, source):
+        if source.action == 'mute':
+            muted = self.scene_items.muted.get(source.source)
+            if muted is None:
+                self.log.warning('Mute state of {0} is unknown'.format(source.source))
+                self.prefetch_sources()
+                return
+            self.log.info('Setting {0} mute {1}'.format(source.source, not muted))
+            self.send_request('SetMute', {'source': source.source, 'mute': not muted})
+            return
+        scene = self.source_scene(source)
+        item = self.scene_items.get_item(scene, source.source)
+        if item is None:
+            self.log.warning('Source {0} is not found in scene {1}'.format(source.source, scene))
+            self.prefetch_sources()
+            return
+        self.log.info('Setting {0} visibility {1} in scene {2}'.format(source.source, not item.visible, scene))
+        self.send_request('SetSceneItemRender', {
+            'scene-name': scene, 'item': {'name': source.source, 'id': item.item_id}, 'render': not item.visible})
+
+    def set_current_scene(self, name, errback=None):
+        self.log.info('Setting scene {0}'.format(name))
+        self.send_request('SetCurrentScene', {'scene-name': name}, callback=self.process_set_scene, errback=errback)
+
+    def process_set_scene(self, resp):
+        if not self.optimistic:
+            self.midi.send_scene_pending_state(self.get_current_scene_index())
 
     def set_current_scene_by_index(self, scene_index):
-        log.debug('Setting scene by index {0}'.format(scene_index))
-        for scene in self.scenes:
-            if scene_index == self.scenes.index(scene):
-                self.set_current_scene(scene['name'])
-                return
-        log.error('No scene with index {0}'.format(scene_index))
+        if self.settings.debug:
+            self.log.debug('Setting scene by index {0}'.format(scene_index))
+        name = self.scenes.name_at(scene_index)
+        if name is None:
+            self.log.error('No scene with index {0}'.format(scene_index))
+            return
+        errback = None
+        shown = self.displayed_state('scene', self.scenes.current_index)
+        if self.optimistic and scene_index != shown:
+            errback = self.predict('scene', scene_index)
+            self.midi.send_scenes_state([shown, scene_index])
+        self.set_current_scene(name, errback)
 
     def get_stream_record_status(self):
-        log.info('Getting stream/record status')
-        self.send_request('GetStreamingStatus', 'STREAM_RECORD_STATUS')
+        self.log.info('Getting stream/record status')
+        return self.send_request('GetStreamingStatus', callback=self.update_stream_record_status)
 
     def update_stream_record_status(self, resp):
-        log.info('Updating stream/record status')
+        self.log.info('Updating stream/record status')
         if resp['streaming']:
             self.streaming_state = STARTED
         else:
@@ -456,55 +2494,105 @@ class OBSControl:
             self.recording_state = STARTED
         else:
             self.recording_state = STOPPED
+        self.reconcile('stream', self.streaming_state)
+        self.reconcile('record', self.recording_state)
         self.midi.send_record_state()
         self.midi.send_stream_state()
 
     def record_toggle(self):
-        log.info('Toggle record state')
-        self.send_request('StartStopRecording')
+        self.log.info('Toggle record state')
+        errback = None
+        if self.optimistic:
+            errback = self.predict_toggle('record', self.recording_state)
+            self.midi.send_record_state()
+        self.send_request('StartStopRecording', errback=errback)
 
     def stream_toggle(self):
-        log.info('Toggle stream state')
-        self.send_request('StartStopStreaming')
+        self.log.info('Toggle stream state')
+        errback = None
+        if self.optimistic:
+            errback = self.predict_toggle('stream', self.streaming_state)
+            self.midi.send_stream_state()
+        self.send_request('StartStopStreaming', errback=errback)
 
     def get_transition_list(self):
-        self.send_request('GetTransitionList', 'GET_TRANSITION_LIST')
+        return self.send_request('GetTransitionList', callback=self.update_transition_list)
 
     def get_current_transition(self):
-        self.send_request('GetCurrentTransition', 'GET_CURRENT_TRANSITION')
+        self.send_request('GetCurrentTransition', callback=self.update_current_transition)
 
     def update_transition_list(self, resp):
-        log.info('Updating transitions list')
+        self.log.info('Updating transitions list')
         self.transitions = resp['transitions']
         self.current_transition = resp['current-transition']
 
     def update_current_transition(self, resp):
         self.current_transition = resp['name']
-        self.current_transition_duration = resp['duration']
+        # Fixed transitions like Cut have no duration
+        self.current_transition_duration = resp.get('duration') or 0
+        self.midi.send_controls_state()
 
-    def exit(self):
-        log.info('=== STOP ===')
-        exit(0)
+    def stop(self):
+        # Stops only this bridge, others sharing the IOLoop keep running
+        self.log.info('=== STOP ===')
+        for throttle in self.control_throttles.values():
+            throttle.cancel()
+        self.ws.stop()
+        self.midi.close_ports()
 
 
 class WebSocketClient:
-    def __init__(self, *, connect_timeout=Config.getint('OBS_Control', 'connect_timeout', fallback=10),
-                 request_timeout=Config.getint('OBS_Control', 'request_timeout', fallback=10)):
+    def __init__(self, *, connect_timeout=10, request_timeout=10, subprotocols=None, write_queue_size=16):
         self.connect_timeout = connect_timeout
         self.request_timeout = request_timeout
+        self.subprotocols = subprotocols
+        self.url = None
+        self._ws_connection = None
+        # Frames are written one by one, next one after socket has taken previous one
+        self.write_queue = deque()
+        self.write_queue_size = write_queue_size
+        self.writing = False
 
     def connect(self, url):
+        self.url = url
         request = httpclient.HTTPRequest(url=url,
                                          connect_timeout=self.connect_timeout,
                                          request_timeout=self.request_timeout)
-        ws_conn = websocket.WebSocketClientConnection(ioloop.IOLoop.current(),
-                                                      request)
-        ws_conn.connect_future.add_done_callback(self._connect_callback)
+        kwargs = {'subprotocols': self.subprotocols} if self.subprotocols else {}
+        websocket.websocket_connect(request, **kwargs).add_done_callback(self._connect_callback)
+
+    @property
+    def selected_subprotocol(self):
+        if not self._ws_connection:
+            return None
+        return self._ws_connection.selected_subprotocol
+
+    @property
+    def writable(self):
+        return len(self.write_queue) < self.write_queue_size
 
     def send(self, data):
         if not self._ws_connection:
             raise RuntimeError('Web socket connection is closed.')
-        self._ws_connection.write_message(data)
+        if not self.writable:
+            raise RuntimeError('Web socket write queue is full.')
+        self.write_queue.append((data, time.perf_counter()))
+        if not self.writing:
+            self._write_messages()
+
+    @gen.coroutine
+    def _write_messages(self):
+        self.writing = True
+        while self.write_queue and self._ws_connection:
+            data, queued_at = self.write_queue.popleft()
+            try:
+                yield self._ws_connection.write_message(data, binary=isinstance(data, bytes))
+            except websocket.WebSocketClosedError:
+                continue
+            self._on_write(time.perf_counter() - queued_at)
+        self.write_queue.clear()
+        self.writing = False
+        self._on_write_queue_empty()
 
     def close(self):
         if not self._ws_connection:
@@ -514,6 +2602,8 @@ class WebSocketClient:
     def _connect_callback(self, future):
         if future.exception() is None:
             self._ws_connection = future.result()
+            # Frames are small and latency-critical, don't let Nagle's algorithm hold them
+            self._ws_connection.protocol.set_nodelay(True)
             self._on_connection_success()
             self._read_messages()
         else:
@@ -521,9 +2611,13 @@ class WebSocketClient:
 
     @gen.coroutine
     def _read_messages(self):
+        ws_connection = self._ws_connection
         while True:
-            msg = yield self._ws_connection.read_message()
+            msg = yield ws_connection.read_message()
             if msg is None:
+                if self._ws_connection is ws_connection:
+                    self._ws_connection = None
+                    self.write_queue.clear()
                 self._on_connection_close()
                 break
             self._on_message(msg)
@@ -531,6 +2625,12 @@ class WebSocketClient:
     def _on_message(self, msg):
         pass
 
+    def _on_write(self, latency):
+        pass
+
+    def _on_write_queue_empty(self):
+        pass
+
     def _on_connection_success(self):
         pass
 
@@ -541,34 +2641,114 @@ class WebSocketClient:
         pass
 
     def __del__(self):
-        if True:
+        if self._ws_connection:
             self.close()
 
 
 class OBSWebSocketClient(WebSocketClient):
+    def __init__(self, obs, **kwargs):
+        kwargs.setdefault('connect_timeout', obs.settings.connect_timeout)
+        kwargs.setdefault('request_timeout', obs.settings.request_timeout)
+        kwargs.setdefault('write_queue_size', obs.settings.write_queue_size)
+        super().__init__(**kwargs)
+        self.obs = obs
+        self.stopped = False
+        self.reconnect_timeout = None
+        self.reconnect_delay = obs.settings.reconnect_delay
+        self.reconnect_max_delay = obs.settings.reconnect_max_delay
+        self.reconnect_attempts = 0
+        self.reconnects = 0
+        self.disconnected_at = None
+
+    def reconnect(self):
+        delay = min(self.reconnect_max_delay, self.reconnect_delay * 2 ** self.reconnect_attempts)
+        delay = random.uniform(delay / 2, delay)
+        self.reconnect_attempts += 1
+        self.obs.log.info('Reconnecting in {0:.2f}s, attempt {1}'.format(delay, self.reconnect_attempts))
+        self.reconnect_timeout = ioloop.IOLoop.current().call_later(delay, self.connect, self.url)
+
     def _on_message(self, msg):
-        ioloop.IOLoop.instance().spawn_callback(OBS.process_response, msg)
+        ioloop.IOLoop.current().spawn_callback(self.obs.process_response, msg)
+
+    def _on_write(self, latency):
+        self.obs.metrics.observe('ws_write_seconds', latency)
+
+    def _on_write_queue_empty(self):
+        if not self.obs.connected:
+            return
+        if self.obs.request_backlog:
+            ioloop.IOLoop.current().add_callback(self.obs.send_request_backlog)
+        if self.obs.protocol.reidentify_pending:
+            ioloop.IOLoop.current().add_callback(self.obs.protocol.update_subscriptions)
 
     def _on_connection_success(self):
-        log.info('Connection success')
-        ioloop.IOLoop().instance().spawn_callback(OBS.get_auth_required)
+        self.obs.log.info('Connection success')
+        if self.reconnect_attempts:
+            self.reconnects += 1
+        self.reconnect_attempts = 0
+        ioloop.IOLoop.current().spawn_callback(self.obs.on_connect)
 
     def _on_connection_close(self):
-        log.info('Connection closed')
-        exit(0)
+        self.obs.log.info('Connection closed')
+        self.on_disconnect()
 
     def _on_connection_error(self, exception):
-        log.error('Connection error: {0}'.format(exception))
-        exit(0)
+        self.obs.log.error('Connection error: {0}'.format(exception))
+        self.on_disconnect()
+
+    def on_disconnect(self):
+        if self.disconnected_at is None:
+            self.disconnected_at = time.monotonic()
+        self.obs.on_disconnect()
+        if not self.stopped:
+            self.reconnect()
+
+    def stop(self):
+        self.stopped = True
+        if self.reconnect_timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(self.reconnect_timeout)
+        if self._ws_connection:
+            self.close()
+
+    def recovered(self):
+        # Returns time from connection loss to resynced state
+        if self.disconnected_at is None:
+            return None
+        recovery_time = time.monotonic() - self.disconnected_at
+        self.disconnected_at = None
+        return recovery_time
+
+
+OBSControl.ws_class = OBSWebSocketClient
+
+
+def flush_captures(bridges):
+    for bridge in bridges:
+        bridge.capture.flush()
+
 
 if __name__ == '__main__':
-    OBS = OBSControl(HOST, PORT, PASSWORD)
-    tlog = logging.getLogger('tornado')
-    tlog_lh = logging.StreamHandler()
-    tlog_lh.setLevel(logging.DEBUG)
-    # tlog_lh.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] : %(message)s'))
-    tlog.addHandler(tlog_lh)
+    import argparse
+    parser = argparse.ArgumentParser(description='OBS-Websockets-MIDI Bridge')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='log time spent in every startup stage until first LED frame with OBS state')
+    args = parser.parse_args()
+    startup_marks = [('imports', time.perf_counter())]
+    config = ConfigParser()
+    config.read(CONFIG_FILE)
+    bridges_settings = load_bridges(config)
+    setup_logger(bridges_settings[0].log_level)
+    startup_marks.append(('config loaded', time.perf_counter()))
+    bridges = [OBSControl(settings, StartupProfile(STARTED_AT, startup_marks) if args.profile_startup else None)
+               for settings in bridges_settings]
+    if bridges_settings[0].metrics_port:
+        start_metrics_server(bridges, bridges_settings[0].metrics_address, bridges_settings[0].metrics_port)
+    loop = ioloop.IOLoop.current()
+    if hasattr(signal, 'SIGUSR1'):
+        # Handler runs as a regular callback of the asyncio loop
+        loop.asyncio_loop.add_signal_handler(signal.SIGUSR1, flush_captures, bridges)
     try:
-        ioloop.IOLoop.instance().start()
+        loop.start()
     except KeyboardInterrupt:
-        OBS.exit()
+        for bridge in bridges:
+            bridge.stop()